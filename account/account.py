@@ -5,15 +5,26 @@ from os import environ
 
 from datetime import datetime
 
+from invokes import cacheable
+from listing import paginate, handle_listing_errors
+from migrations import verify_schema, create_tables, create_index
+
 app = Flask(__name__)
 app.config['JSON_SORT_KEYS'] = False
 app.config['SQLALCHEMY_DATABASE_URI'] = environ.get('dbURL')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_recycle': 299}
 
+# Seconds that callers may serve an account lookup from their cache before revalidating it.
+account_cache_ttl = int(environ.get('accountCacheTTL') or 30)
+
+# Upper bound on the number of ids a single batch lookup may ask for.
+max_batch_ids = int(environ.get('accountMaxBatchIds') or 500)
+
 db = SQLAlchemy(app)
 
 CORS(app)
+handle_listing_errors(app)
 
 class Account(db.Model):
     __tablename__ = 'accounts'
@@ -46,8 +57,14 @@ class Account(db.Model):
 
 
 
+# schema changes, in order; see common/migrations.py
+MIGRATIONS = [
+    create_tables(db),
+    create_index("accounts", "accounts_email", ["email"], unique=True),
+]
+
 with app.app_context():
-    db.create_all()
+    verify_schema(db, MIGRATIONS)
     existing_account_1 = db.session.query(Account).filter(Account.account_id==1).first()
     if not existing_account_1:
       new_account_1 = Account(first_name="Benji", last_name="Ng", date_of_birth="2000-01-01", age=23, gender="M", email="kangting.ng.2021@scis.smu.edu.sg", phone="+6597861048", is_priority=0, is_active=1)
@@ -68,14 +85,17 @@ with app.app_context():
 
 @app.route("/account")
 def get_all():
-    accountlist = Account.query.all()
+    accountlist, next_cursor = paginate(Account.query, Account.account_id, filters={
+        "email": Account.email, "is_priority": Account.is_priority, "is_active": Account.is_active
+    })
     if len(accountlist):
         return jsonify(
             {
                 "code": 200,
                 "data": {
                     "accounts": [account.json() for account in accountlist]
-                }
+                },
+                "next_cursor": next_cursor
             }
         ), 200
     return jsonify(
@@ -86,7 +106,73 @@ def get_all():
     ), 404
 
 
+@app.route("/account/batch", methods=['GET', 'POST'])
+def find_by_account_ids():
+    # ids/fields come as comma separated query args on GET, or as JSON lists on POST for long lists.
+    if request.method == 'POST':
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get("ids"), list) or not isinstance(data.get("fields") or [], list):
+            return jsonify(
+                {
+                    "code": 400,
+                    "message": "Expected an object with a list of \"ids\" and an optional list of \"fields\"."
+                }
+            ), 400
+        ids = data["ids"]
+        fields = data.get("fields") or []
+    else:
+        ids = [account_id for account_id in request.args.get("ids", "").split(",") if account_id]
+        fields = [field for field in request.args.get("fields", "").split(",") if field]
+
+    try:
+        ids = list(dict.fromkeys(int(account_id) for account_id in ids))
+    except (TypeError, ValueError):
+        return jsonify(
+            {
+                "code": 400,
+                "message": "Account ids must be integers."
+            }
+        ), 400
+
+    if not ids or len(ids) > max_batch_ids:
+        return jsonify(
+            {
+                "code": 400,
+                "message": "Between 1 and " + str(max_batch_ids) + " account ids are required."
+            }
+        ), 400
+
+    columns = Account.__table__.columns
+    unknown_fields = [field for field in fields if not isinstance(field, str) or field not in columns]
+    if unknown_fields:
+        return jsonify(
+            {
+                "code": 400,
+                "data": {
+                    "fields": unknown_fields
+                },
+                "message": "Unknown account fields."
+            }
+        ), 400
+
+    # account_id is always selected, it keys the result.
+    selected = ["account_id"] + [field for field in fields if field != "account_id"] if fields else list(columns.keys())
+    rows = db.session.query(*[columns[field] for field in selected]).filter(Account.account_id.in_(ids)).all()
+
+    accounts = {str(row.account_id): dict(zip(selected, row)) for row in rows}
+    return jsonify(
+        {
+            "code": 200,
+            "data": {
+                "accounts": accounts,
+                "not_found": [account_id for account_id in ids if str(account_id) not in accounts]
+            }
+        }
+    ), 200
+
+
 @app.route("/account/<account_id>")
+@cacheable(account_cache_ttl)
 def find_by_account_id(account_id):
     account = Account.query.filter_by(account_id=account_id).first()
     if account:
@@ -4,7 +4,9 @@ from flask_cors import CORS
 from os import environ
 from datetime import datetime
 
-from invokes import invoke_http
+from invokes import invoke_http, propagate_deadline
+from listing import paginate, handle_listing_errors
+from migrations import verify_schema, create_tables
 
 app = Flask(__name__)
 app.config['JSON_SORT_KEYS'] = False
@@ -15,6 +17,8 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_recycle': 299}
 db = SQLAlchemy(app)
 
 CORS(app)
+propagate_deadline(app)
+handle_listing_errors(app)
 
 verification_URL = environ.get('verificationURL') or "http://localhost:6001/verification/"
 
@@ -38,19 +42,27 @@ class Broadcast(db.Model):
     def json(self):
         return {"broadcasted_id": self.broadcasted_id,"lf_pax": self.lf_pax,"date_of_visit":self.date_of_visit,"datetime_of_broadcast":self.datetime_of_broadcast}
 
+# schema changes, in order; see common/migrations.py
+MIGRATIONS = [
+    create_tables(db),
+]
+
 with app.app_context():
-    db.create_all()
+    verify_schema(db, MIGRATIONS)
 
 @app.route("/broadcast")
 def get_all():
-    broadcastlist = Broadcast.query.all()
+    broadcastlist, next_cursor = paginate(Broadcast.query, Broadcast.broadcasted_id, filters={
+        "date_of_visit": Broadcast.date_of_visit
+    })
     if len(broadcastlist):
         return jsonify(
             {
                 "code": 200,
                 "data": {
                     "notice": [broadcast.json() for broadcast in broadcastlist]
-                }
+                },
+                "next_cursor": next_cursor
             }
         )
     return jsonify(
@@ -90,7 +102,7 @@ def create_broadcast(broadcasted_id):
     # lf_pax = INT
     # Date format: YYYY-MM-DD
     # Datetime is auto populated from SQL Server
-    group_result = invoke_http(verification_URL + "grouping/" + str(broadcasted_id), method='GET')
+    group_result = invoke_http(verification_URL + "grouping/" + str(broadcasted_id), method='GET', coalesce=True)
     print(group_result)
     # Check Account Result is within the code range else return error msg
     if group_result["code"] in range(500, 600):
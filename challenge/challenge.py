@@ -4,12 +4,14 @@ from flask_cors import CORS
 from os import environ
 
 from datetime import datetime, timedelta
+import asyncio
 
-from invokes import invoke_http
+from invokes import invoke_http, invoke_many, propagate_deadline
+from listing import paginate, stream_rows, wants_stream, handle_listing_errors
+from migrations import verify_schema, create_tables, create_index, add_column, run_sql
 
 import amqp_setup
-import pika
-import json
+import messages
 
 
 app = Flask(__name__)
@@ -21,6 +23,8 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_recycle': 299}
 db = SQLAlchemy(app)
 
 CORS(app)
+propagate_deadline(app)
+handle_listing_errors(app)
 
 verification_URL = environ.get(
     'verificationURL') or "http://localhost:6001/verification/"
@@ -37,6 +41,7 @@ class Challenge(db.Model):
     end_date = db.Column(db.DateTime, nullable=False)
     status = db.Column(db.String(64), nullable=False, default="In Progress")
     complete_date = db.Column(db.DateTime)
+    credited = db.Column(db.Boolean, nullable=False, default=False, server_default="0") # loyalty accepted the points
     created = db.Column(db.DateTime, nullable=False, default=datetime.now)
     modified = db.Column(db.DateTime, nullable=False,
                          default=datetime.now, onupdate=datetime.now)
@@ -49,20 +54,36 @@ class Challenge(db.Model):
         return {"challenge_id": self.challenge_id, "account_id": self.account_id, "mission_id": self.mission_id, "start_date": self.start_date, "end_date": self.end_date, "status": self.status, "complete_date": self.complete_date, "created": self.created, "modified": self.modified}
 
 
+# schema changes, in order; see common/migrations.py
+MIGRATIONS = [
+    create_tables(db),
+    create_index("challenges", "challenges_account_mission", ["account_id", "mission_id"], unique=True),
+    # challenges completed before credits were tracked had their points credited already
+    add_column("challenges", "credited", "BOOLEAN NOT NULL DEFAULT 0"),
+    run_sql("UPDATE challenges SET credited = 1 WHERE status = 'Completed'"),
+]
+
 with app.app_context():
-    db.create_all()
+    verify_schema(db, MIGRATIONS)
 
 
 @app.route("/challenge")
 def get_all():
-    challengelist = Challenge.query.all()
+    filters = {
+        "account_id": Challenge.account_id, "mission_id": Challenge.mission_id, "status": Challenge.status
+    }
+    if wants_stream():
+        return stream_rows(Challenge.query, Challenge.challenge_id, filters=filters)
+
+    challengelist, next_cursor = paginate(Challenge.query, Challenge.challenge_id, filters=filters)
     if len(challengelist):
         return jsonify(
             {
                 "code": 200,
                 "data": {
                     "challenges": [challenge.json() for challenge in challengelist],
-                }
+                },
+                "next_cursor": next_cursor
             }
         ), 200
     return jsonify(
@@ -138,7 +159,7 @@ def create_challenge():
     challenge = Challenge(**data)
 
     account_result = invoke_http(
-        verification_URL + "account/" + str(challenge.account_id), method='GET')
+        verification_URL + "account/" + str(challenge.account_id), method='GET', cache=True, coalesce=True)
 
     if account_result["code"] in range(500, 600):
         return jsonify(
@@ -160,7 +181,7 @@ def create_challenge():
         ), 400
 
     mission_result = invoke_http(
-        verification_URL + "mission/" + str(challenge.mission_id), method='GET')
+        verification_URL + "mission/" + str(challenge.mission_id), method='GET', cache=True, coalesce=True)
 
     if mission_result["code"] in range(500, 600):
         return jsonify(
@@ -230,6 +251,36 @@ def create_challenge():
     ), 201
 
 
+def claim_challenges(challenge_ids, complete_date):
+    # "In Progress" -> "Completed" by a guarded UPDATE per challenge, committed before any points are credited:
+    # whoever moves a challenge out of "In Progress" is the one caller that credits it, and no row lock is
+    # held across the loyalty call
+    claimed = []
+    for challenge_id in challenge_ids:
+        if Challenge.query.filter(Challenge.challenge_id == challenge_id, Challenge.status == "In Progress").update(
+                {Challenge.status: "Completed", Challenge.complete_date: complete_date}, synchronize_session=False):
+            claimed.append(challenge_id)
+    db.session.commit()
+    return claimed
+
+
+def release_challenges(challenge_ids):
+    # undo claim_challenges for challenges whose points loyalty refused, so they can be completed again
+    if challenge_ids:
+        Challenge.query.filter(Challenge.challenge_id.in_(challenge_ids), Challenge.status == "Completed").update(
+            {Challenge.status: "In Progress", Challenge.complete_date: None}, synchronize_session=False)
+        db.session.commit()
+
+
+def credit_challenges(challenge_ids):
+    # loyalty accepted the points; until then a completed challenge is credited again, under the same
+    # idempotency key, when its completion is retried
+    if challenge_ids:
+        Challenge.query.filter(Challenge.challenge_id.in_(challenge_ids)).update(
+            {Challenge.credited: True}, synchronize_session=False)
+        db.session.commit()
+
+
 @app.route("/challenge/<challenge_id>/complete", methods=['PATCH'])
 def update_challenge_complete(challenge_id):
     if (not Challenge.query.filter_by(challenge_id=challenge_id).first()):
@@ -245,7 +296,7 @@ def update_challenge_complete(challenge_id):
 
     challenge = Challenge.query.filter_by(challenge_id=challenge_id).first()
 
-    if challenge.status == "Completed":
+    if challenge.status == "Completed" and challenge.credited:
         return jsonify(
             {
                 "code": 400,
@@ -257,7 +308,7 @@ def update_challenge_complete(challenge_id):
         ), 400
 
     mission_result = invoke_http(
-        verification_URL + "mission/" + str(challenge.mission_id), method='GET')
+        verification_URL + "mission/" + str(challenge.mission_id), method='GET', cache=True, coalesce=True)
 
     if mission_result["code"] in range(500, 600):
         return jsonify(
@@ -278,14 +329,48 @@ def update_challenge_complete(challenge_id):
             }
         ), 400
 
+    try:
+        # a challenge claimed before whose credit timed out or failed keeps its claim and is credited again
+        claimed = [challenge.challenge_id] if challenge.status == "Completed" else claim_challenges([challenge.challenge_id], datetime.now())
+
+    except:
+        db.session.rollback()
+        return jsonify(
+            {
+                "code": 500,
+                "data": {
+                    "challenge_id": challenge_id
+                },
+                "message": "An error occurred updating the challenge."
+            }
+        ), 500
+
+    if not claimed:
+        return jsonify(
+            {
+                "code": 400,
+                "data": {
+                    "challenge_id": challenge_id
+                },
+                "message": "Challenge is already completed."
+            }
+        ), 400
+
     earn_json = {
-        "points": mission_result["data"]["award_points"]
+        "points": mission_result["data"]["award_points"],
+        "idempotency_key": "challenge:" + str(challenge.challenge_id)
     }
 
     earn_result = invoke_http(
         loyalty_URL + str(challenge.account_id) + "/earn", method='PATCH', json=earn_json)
 
-    if earn_result["code"] in range(500, 600):
+    # only a definite refusal releases the claim; after a timeout or a 5xx the points may have been credited,
+    # so the claim is kept and a retry sends the same idempotency key
+    if earn_result["code"] in range(400, 500):
+        release_challenges(claimed)
+        return jsonify(earn_result), 400
+
+    if earn_result["code"] not in range(200, 300):
         return jsonify(
             {
                 "code": 500,
@@ -293,40 +378,181 @@ def update_challenge_complete(challenge_id):
             }
         ), 500
 
-    if earn_result["code"] in range(300, 500):
-        return jsonify(earn_result), 400
+    credit_challenges(claimed)
+
+    account_result = invoke_http(
+        verification_URL + "account/" + str(challenge.account_id), method='GET', cache=True, coalesce=True)
+
+    notification_message = messages.Completion(idempotency_key="completion:" + str(challenge.challenge_id), mission_name=mission_result["data"]["name"], first_name=account_result["data"]
+                            ["first_name"], phone_number=account_result["data"]["phone"], award_points=mission_result["data"]["award_points"])
+
+    message, properties = messages.encode(notification_message)
+
+    amqp_setup.publish(amqp_setup.exchangename, "notification.sms", message, properties, callback=amqp_setup.log_unconfirmed)
+
+    return jsonify(
+        {
+            "code": 200,
+            "data": challenge.json()
+        }
+    ), 200
+
+
+@app.route("/challenge/complete/bulk", methods=['POST'])
+def complete_challenges_bulk():
+    # Complete many challenges at once, e.g. [{"account_id": 1, "mission_id": 1}, ...]: every mission is
+    # fetched once, the challenges are claimed in one transaction and the points credited in one loyalty call.
+    if not request.is_json:
+        return jsonify(
+            {
+                "code": 400,
+                "message": "Invalid JSON input: " + str(request.get_data())
+            }
+        ), 400
+
+    data = request.get_json()
+    requested = data.get("challenges") if isinstance(data, dict) else data
 
+    account_ids_by_mission = {}
     try:
-        challenge.status = "Completed"
-        challenge.complete_date = datetime.now()
-        db.session.commit()
+        for item in requested:
+            account_ids_by_mission.setdefault(int(item["mission_id"]), set()).add(int(item["account_id"]))
+    except (TypeError, KeyError, ValueError):
+        return jsonify(
+            {
+                "code": 400,
+                "message": "Expected a list of {account_id, mission_id} with whole-number ids."
+            }
+        ), 400
+
+    mission_ids = list(account_ids_by_mission)
+    mission_results = dict(zip(mission_ids, asyncio.run(invoke_many([
+        {"url": verification_URL + "mission/" + str(mission_id), "method": 'GET', "cache": True, "coalesce": True}
+        for mission_id in mission_ids
+    ]))))
+
+    if any(mission_result["code"] in range(500, 600) for mission_result in mission_results.values()):
+        return jsonify(
+            {
+                "code": 500,
+                "message": "Oops, something went wrong!"
+            }
+        ), 500
+
+    skipped = []
+    challengelist = []
+    for mission_id, account_ids in account_ids_by_mission.items():
+        if mission_results[mission_id]["code"] not in range(200, 300):
+            skipped += [{"account_id": account_id, "mission_id": mission_id, "message": "Mission not found"}
+                        for account_id in account_ids]
+            continue
+
+        # challenges claimed before whose credit timed out or failed are credited again with the rest
+        uncredited = Challenge.query.filter(
+            Challenge.mission_id == mission_id, Challenge.account_id.in_(account_ids),
+            Challenge.credited == False).all()
+        challengelist += uncredited
+
+    # a challenge completed concurrently since it was read is simply not claimed here
+    try:
+        claimed = set(challenge.challenge_id for challenge in challengelist if challenge.status == "Completed")
+        claimed.update(claim_challenges([challenge.challenge_id for challenge in challengelist
+                                         if challenge.challenge_id not in claimed], datetime.now()))
 
     except:
+        db.session.rollback()
         return jsonify(
             {
                 "code": 500,
+                "message": "An error occurred updating the challenges."
+            }
+        ), 500
+
+    challengelist = [challenge for challenge in challengelist if challenge.challenge_id in claimed]
+    for mission_id, account_ids in account_ids_by_mission.items():
+        if mission_results[mission_id]["code"] not in range(200, 300):
+            continue
+        found = set(challenge.account_id for challenge in challengelist if challenge.mission_id == mission_id)
+        skipped += [{"account_id": account_id, "mission_id": mission_id, "message": "No challenge in progress."}
+                    for account_id in account_ids - found]
+
+    if not challengelist:
+        return jsonify(
+            {
+                "code": 200,
                 "data": {
-                    "challenge": challenge
+                    "challenges": [],
+                    "skipped": skipped
+                }
+            }
+        ), 200
+
+    earn_json = {
+        "earns": [{"account_id": challenge.account_id, "points": mission_results[challenge.mission_id]["data"]["award_points"],
+                   "idempotency_key": "challenge:" + str(challenge.challenge_id)}
+                  for challenge in challengelist]
+    }
+
+    earn_result = invoke_http(
+        loyalty_URL + "batch/earn", method='PATCH', json=earn_json)
+
+    # as for a single challenge, only a definite refusal releases the claims
+    if earn_result["code"] in range(400, 500):
+        release_challenges([challenge.challenge_id for challenge in challengelist])
+        return jsonify(
+            {
+                "code": 400,
+                "data": {
+                    "earn_result": earn_result
                 },
-                "message": "An error occurred updating the challenge."
+                "message": "The points could not be credited."
+            }
+        ), 400
+
+    if earn_result["code"] not in range(200, 300):
+        return jsonify(
+            {
+                "code": 500,
+                "data": {
+                    "earn_result": earn_result
+                },
+                "message": "Oops, something went wrong!"
             }
         ), 500
 
-    account_result = invoke_http(
-        verification_URL + "account/" + str(challenge.account_id), method='GET')
+    not_found = set(earn_result["data"]["not_found"])
+    skipped += [{"account_id": challenge.account_id, "mission_id": challenge.mission_id, "message": "Loyalty not found."}
+                for challenge in challengelist if challenge.account_id in not_found]
+    release_challenges([challenge.challenge_id for challenge in challengelist if challenge.account_id in not_found])
+    challengelist = [challenge for challenge in challengelist if challenge.account_id not in not_found]
+    credit_challenges([challenge.challenge_id for challenge in challengelist])
+
+    batch = {
+        "lookups": [{"kind": "account", "id": challenge.account_id} for challenge in challengelist],
+        "fields": {"account": ["first_name", "phone"]}
+    }
+    account_results = invoke_http(verification_URL + "batch", method='POST', json=batch)
 
-    notification_message = {"type": "completion", "mission_name": mission_result["data"]["name"], "first_name": account_result["data"]
-                            ["first_name"], "phone_number": account_result["data"]["phone"], "award_points": mission_result["data"]["award_points"]}
+    for challenge in challengelist:
+        account_result = account_results.get("data", {}).get("account", {}).get(str(challenge.account_id))
+        if not account_result or account_result["code"] not in range(200, 300):
+            continue
 
-    message = json.dumps(notification_message)
+        mission = mission_results[challenge.mission_id]["data"]
+        notification_message = messages.Completion(idempotency_key="completion:" + str(challenge.challenge_id), mission_name=mission["name"], first_name=account_result["data"]
+                                ["first_name"], phone_number=account_result["data"]["phone"], award_points=mission["award_points"])
 
-    amqp_setup.channel.basic_publish(exchange=amqp_setup.exchangename, routing_key="notification.sms",
-                                     body=message, properties=pika.BasicProperties(delivery_mode=2))
+        message, properties = messages.encode(notification_message)
+
+        amqp_setup.publish(amqp_setup.exchangename, "notification.sms", message, properties, callback=amqp_setup.log_unconfirmed)
 
     return jsonify(
         {
             "code": 200,
-            "data": challenge.json()
+            "data": {
+                "challenges": [challenge.json() for challenge in challengelist],
+                "skipped": skipped
+            }
         }
     ), 200
 
@@ -1,112 +1,412 @@
-import pika
-
-from os import environ
-
-# These module-level variables are initialized whenever a new instance of python interpreter imports the module;
-# In each instance of python interpreter (i.e., a program run), the same module is only imported once (guaranteed by the interpreter).
-
-hostname = environ.get("RABBITMQ_HOST", "localhost") # default hostname
-port = 5672 # default port
-# connect to the broker and set up a communication channel in the connection
-connection = pika.BlockingConnection(
-    pika.ConnectionParameters(
-        host=hostname, port=port,
-        heartbeat=3600, blocked_connection_timeout=3600, # these parameters to prolong the expiration time (in seconds) of the connection
-))
-    # Note about AMQP connection: various network firewalls, filters, gateways (e.g., SMU VPN on wifi), may hinder the connections;
-    # If "pika.exceptions.AMQPConnectionError" happens, may try again after disconnecting the wifi and/or disabling firewalls.
-    # If see: Stream connection lost: ConnectionResetError(10054, 'An existing connection was forcibly closed by the remote host', None, 10054, None)
-    # - Try: simply re-run the program or refresh the page.
-    # For rare cases, it's incompatibility between RabbitMQ and the machine running it,
-    # - Use the Docker version of RabbitMQ instead: https://www.rabbitmq.com/download.html
-channel = connection.channel()
-# Set up the exchange if the exchange doesn't exist
-# - use a 'topic' exchange to enable interaction
-exchangename="notification_topic"
-exchangetype="topic"
-channel.exchange_declare(exchange=exchangename, exchange_type=exchangetype, durable=True)
-    # 'durable' makes the exchange survive broker restarts
-
-# Here can be a place to set up all queues needed by the microservices,
-# - instead of setting up the queues using RabbitMQ UI.
-
-############   Error queue   #############
-#delcare Error queue
-queue_name = 'Error'
-channel.queue_declare(queue=queue_name, durable=True)
-    # 'durable' makes the queue survive broker restarts
-
-#bind Error queue
-channel.queue_bind(exchange=exchangename, queue=queue_name, routing_key='*.error') 
-    # bind the queue to the exchange via the key
-    # any routing_key with two words and ending with '.error' will be matched
-
-############   SMS queue    #############
-#delcare SMS queue
-queue_name = 'SMS'
-channel.queue_declare(queue=queue_name, durable=True)
-    # 'durable' makes the queue survive broker restarts
-
-#bind SMS queue
-channel.queue_bind(exchange=exchangename, queue=queue_name, routing_key='*.sms') 
-    # bind the queue to the exchange via the key
-    # any routing_key with two words and ending with '.error' will be matched
-
-
-############   Email queue    #############
-#delcare Email queue
-queue_name = 'Email'
-channel.queue_declare(queue=queue_name, durable=True)
-    # 'durable' makes the queue survive broker restarts
-
-#bind Email queue
-channel.queue_bind(exchange=exchangename, queue=queue_name, routing_key='*.email')
-    # bind the queue to the exchange via the key
-    # any routing_key with two words and ending with '.error' will be matched
-
-
-
-# - use a 'direct' exchange to enable interaction
-exchangename1="challenge_direct"
-exchangetype1="direct"
-channel.exchange_declare(exchange=exchangename1, exchange_type=exchangetype1, durable=True)
-    # 'durable' makes the exchange survive broker restarts
-
-
-############   Complete queue    #############
-#delcare Complete queue
-queue_name = 'challenge_complete'
-channel.queue_declare(queue=queue_name, durable=True)
-channel.queue_bind(exchange=exchangename1, queue=queue_name, routing_key='challenge.challenge_complete')
-
-
-
-"""
-This function in this module sets up a connection and a channel to a local AMQP broker,
-and declares a 'topic' exchange to be used by the microservices in the solution.
-"""
-def check_setup():
-    # The shared connection and channel created when the module is imported may be expired, 
-    # timed out, disconnected by the broker or a client;
-    # - re-establish the connection/channel is they have been closed
-    global connection, channel, hostname, port, exchangename, exchangetype
-
-    if not is_connection_open(connection):
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host=hostname, port=port, heartbeat=3600, blocked_connection_timeout=3600))
-    if channel.is_closed:
-        channel = connection.channel()
-        channel.exchange_declare(exchange=exchangename, exchange_type=exchangetype, durable=True)
-
-
-def is_connection_open(connection):
-    # For a BlockingConnection in AMQP clients,
-    # when an exception happens when an action is performed,
-    # it likely indicates a broken connection.
-    # So, the code below actively calls a method in the 'connection' to check if an exception happens
-    try:
-        connection.process_data_events()
-        return True
-    except pika.exceptions.AMQPError as e:
-        print("AMQP Error:", e)
-        print("...creating a new connection.")
-        return False
+import pika
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from os import environ
+
+# These module-level variables are initialized whenever a new instance of python interpreter imports the module;
+# In each instance of python interpreter (i.e., a program run), the same module is only imported once (guaranteed by the interpreter).
+
+hostname = environ.get("RABBITMQ_HOST", "localhost") # default hostname
+port = 5672 # default port
+# connect to the broker and set up a communication channel in the connection
+connection = pika.BlockingConnection(
+    pika.ConnectionParameters(
+        host=hostname, port=port,
+        heartbeat=3600, blocked_connection_timeout=3600, # these parameters to prolong the expiration time (in seconds) of the connection
+))
+    # Note about AMQP connection: various network firewalls, filters, gateways (e.g., SMU VPN on wifi), may hinder the connections;
+    # If "pika.exceptions.AMQPConnectionError" happens, may try again after disconnecting the wifi and/or disabling firewalls.
+    # If see: Stream connection lost: ConnectionResetError(10054, 'An existing connection was forcibly closed by the remote host', None, 10054, None)
+    # - Try: simply re-run the program or refresh the page.
+    # For rare cases, it's incompatibility between RabbitMQ and the machine running it,
+    # - Use the Docker version of RabbitMQ instead: https://www.rabbitmq.com/download.html
+channel = connection.channel()
+# Set up the exchange if the exchange doesn't exist
+# - use a 'topic' exchange to enable interaction
+exchangename="notification_topic"
+exchangetype="topic"
+channel.exchange_declare(exchange=exchangename, exchange_type=exchangetype, durable=True)
+    # 'durable' makes the exchange survive broker restarts
+
+# Here can be a place to set up all queues needed by the microservices,
+# - instead of setting up the queues using RabbitMQ UI.
+
+############   Error queue   #############
+#delcare Error queue
+queue_name = 'Error'
+channel.queue_declare(queue=queue_name, durable=True)
+    # 'durable' makes the queue survive broker restarts
+
+#bind Error queue
+channel.queue_bind(exchange=exchangename, queue=queue_name, routing_key='*.error') 
+    # bind the queue to the exchange via the key
+    # any routing_key with two words and ending with '.error' will be matched
+
+############   SMS queue    #############
+#delcare SMS queue
+queue_name = 'SMS'
+channel.queue_declare(queue=queue_name, durable=True)
+    # 'durable' makes the queue survive broker restarts
+
+#bind SMS queue
+channel.queue_bind(exchange=exchangename, queue=queue_name, routing_key='*.sms') 
+    # bind the queue to the exchange via the key
+    # any routing_key with two words and ending with '.error' will be matched
+
+
+############   Email queue    #############
+#delcare Email queue
+queue_name = 'Email'
+channel.queue_declare(queue=queue_name, durable=True)
+    # 'durable' makes the queue survive broker restarts
+
+#bind Email queue
+channel.queue_bind(exchange=exchangename, queue=queue_name, routing_key='*.email')
+    # bind the queue to the exchange via the key
+    # any routing_key with two words and ending with '.error' will be matched
+
+
+
+# - use a 'direct' exchange to enable interaction
+exchangename1="challenge_direct"
+exchangetype1="direct"
+channel.exchange_declare(exchange=exchangename1, exchange_type=exchangetype1, durable=True)
+    # 'durable' makes the exchange survive broker restarts
+
+
+############   Complete queue    #############
+#delcare Complete queue
+queue_name = 'challenge_complete'
+channel.queue_declare(queue=queue_name, durable=True)
+channel.queue_bind(exchange=exchangename1, queue=queue_name, routing_key='challenge.challenge_complete')
+
+
+
+"""
+This function in this module sets up a connection and a channel to a local AMQP broker,
+and declares a 'topic' exchange to be used by the microservices in the solution.
+"""
+def check_setup():
+    # The shared connection and channel created when the module is imported may be expired, 
+    # timed out, disconnected by the broker or a client;
+    # - re-establish the connection/channel is they have been closed
+    global connection, channel, hostname, port, exchangename, exchangetype
+
+    if not is_connection_open(connection):
+        connection = pika.BlockingConnection(pika.ConnectionParameters(host=hostname, port=port, heartbeat=3600, blocked_connection_timeout=3600))
+    if channel.is_closed:
+        channel = connection.channel()
+        channel.exchange_declare(exchange=exchangename, exchange_type=exchangetype, durable=True)
+
+
+def is_connection_open(connection):
+    # For a BlockingConnection in AMQP clients,
+    # when an exception happens when an action is performed,
+    # it likely indicates a broken connection.
+    # So, the code below actively calls a method in the 'connection' to check if an exception happens
+    try:
+        connection.process_data_events()
+        return True
+    except pika.exceptions.AMQPError as e:
+        print("AMQP Error:", e)
+        print("...creating a new connection.")
+        return False
+
+
+############   Publisher    #############
+# A BlockingConnection and its channels must only be used by one thread at a time,
+# so Flask request threads publish through a small pool of connections instead of the shared 'channel' above.
+# Each pooled connection is checked out by one thread for the duration of a publish,
+# and a broken one is dropped and replaced lazily, with backoff, on the next publish.
+
+publisher_pool_size = int(environ.get("AMQP_PUBLISHER_POOL_SIZE", 4)) # connections kept open for publishing
+publish_retries = int(environ.get("AMQP_PUBLISH_RETRIES", 3)) # reconnect attempts before a publish gives up
+publish_backoff = float(environ.get("AMQP_PUBLISH_BACKOFF", 0.2)) # seconds, doubled after every failed attempt
+publish_wait_timeout = float(environ.get("AMQP_PUBLISH_WAIT_TIMEOUT", 10)) # seconds a publish waits for a free connection, or for room in confirm mode
+
+_idle_publishers = queue.LifoQueue() # most recently used first, so idle connections age out
+_publishers_open = 0
+_publishers_lock = threading.Lock()
+
+
+def publish(exchange, routing_key, body, properties=None, callback=None):
+    """Publish one message, safe to call from any thread.
+       properties: pika.BasicProperties of the message; persistent (delivery_mode=2) by default;
+       callback: called with the returned future once the outcome of the message is known;
+       return: a concurrent.futures.Future. In confirm mode (AMQP_CONFIRM_MODE=1) it resolves to True once
+            the broker confirms the message and fails with PublishNotConfirmed otherwise; in the default
+            fire-and-forget mode it is already resolved when publish returns.
+       Raises the last pika.exceptions.AMQPError if, in fire-and-forget mode, the broker stays unreachable after the retries;
+       raises PublishNotConfirmed if, in confirm mode, the backlog stays full for AMQP_PUBLISH_WAIT_TIMEOUT seconds.
+    """
+    if properties is None:
+        properties = pika.BasicProperties(delivery_mode=2)
+
+    if confirm_mode:
+        future = _get_confirming_publisher().publish(exchange, routing_key, body, properties)
+    else:
+        _publish_pooled(exchange, routing_key, body, properties)
+        future = Future()
+        future.set_result(True)
+
+    if callback is not None:
+        future.add_done_callback(callback)
+    return future
+
+
+def _publish_pooled(exchange, routing_key, body, properties):
+    delay = publish_backoff
+    for attempt in range(publish_retries + 1):
+        publisher = None
+        published = False
+        try:
+            publisher = _checkout_publisher()
+            publisher[1].basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+            published = True
+            return
+        except pika.exceptions.AMQPError as e:
+            print("AMQP Error:", e, flush=True)
+            print("...dropping the publisher connection.", flush=True)
+            if attempt == publish_retries:
+                raise
+        finally:
+            # a publisher always goes back to the pool or is closed, whatever was raised
+            if published:
+                _checkin_publisher(publisher)
+            else:
+                _discard_publisher(publisher)
+        time.sleep(delay)
+        delay *= 2
+
+
+def _checkout_publisher():
+    global _publishers_open
+
+    try:
+        return _idle_publishers.get_nowait()
+    except queue.Empty:
+        pass
+
+    deadline = time.monotonic() + publish_wait_timeout
+    while True:
+        with _publishers_lock:
+            can_open = _publishers_open < publisher_pool_size
+            if can_open:
+                _publishers_open += 1
+        if can_open:
+            break
+        # every connection is busy: wait for one to be returned, and look again now and then, as a
+        # discarded connection frees a place in the pool without returning anything to the queue
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise pika.exceptions.AMQPConnectionError("no publisher connection free within " + str(publish_wait_timeout) + " seconds")
+        try:
+            return _idle_publishers.get(timeout=min(remaining, 0.5))
+        except queue.Empty:
+            pass
+
+    try:
+        publisher_connection = pika.BlockingConnection(pika.ConnectionParameters(host=hostname, port=port, heartbeat=3600, blocked_connection_timeout=3600))
+        return (publisher_connection, publisher_connection.channel())
+    except Exception:
+        with _publishers_lock:
+            _publishers_open -= 1
+        raise
+
+
+def _checkin_publisher(publisher):
+    _idle_publishers.put(publisher)
+
+
+def _discard_publisher(publisher):
+    global _publishers_open
+
+    if publisher is None:
+        return
+    with _publishers_lock:
+        _publishers_open -= 1
+    try:
+        publisher[0].close()
+    except Exception:
+        pass
+
+
+############   Publisher confirms    #############
+# In confirm mode, messages are pipelined on one channel with publisher confirms turned on:
+# publishes are queued, written to the broker in windows (AMQP_CONFIRM_WINDOW_SIZE messages or
+# AMQP_CONFIRM_WINDOW_MS milliseconds, whichever comes first) and each message's future is resolved
+# when the broker acks or nacks it, so no publish waits for a round trip of its own.
+
+confirm_mode = environ.get("AMQP_CONFIRM_MODE", "0") == "1"
+confirm_window_size = int(environ.get("AMQP_CONFIRM_WINDOW_SIZE", 100)) # messages written per window
+confirm_window_ms = float(environ.get("AMQP_CONFIRM_WINDOW_MS", 5)) # longest a queued message waits to be written
+confirm_max_unconfirmed = int(environ.get("AMQP_CONFIRM_MAX_UNCONFIRMED", 5000)) # publish blocks above this many queued or unconfirmed messages
+confirm_timeout = float(environ.get("AMQP_CONFIRM_TIMEOUT", 30)) # seconds a written message may wait for its confirm
+
+
+class PublishNotConfirmed(Exception):
+    # The broker nacked the message, or its fate is unknown (connection lost or no confirm in time).
+    pass
+
+
+class ConfirmingPublisher:
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.queued = deque() # (future, exchange, routing_key, body, properties) not yet written
+        self.unconfirmed = OrderedDict() # delivery tag -> (future, time written)
+        self.connection = None
+        self.channel = None
+        self.next_tag = 1
+        self.flush_scheduled = False
+
+        thread = threading.Thread(target=self._run, name="amqp_confirms", daemon=True)
+        thread.start()
+
+    def publish(self, exchange, routing_key, body, properties):
+        future = Future()
+        with self.lock:
+            # while the broker is away nothing is confirmed and the backlog stays full: give up in time
+            if not self.lock.wait_for(lambda: len(self.queued) + len(self.unconfirmed) < confirm_max_unconfirmed,
+                                      timeout=publish_wait_timeout):
+                raise PublishNotConfirmed("more than " + str(confirm_max_unconfirmed) + " messages waiting for the broker")
+            self.queued.append((future, exchange, routing_key, body, properties))
+            flush_now = len(self.queued) >= confirm_window_size
+            schedule = not flush_now and not self.flush_scheduled
+            if schedule:
+                self.flush_scheduled = True
+            connection = self.connection
+
+        if connection is not None and (flush_now or schedule):
+            callback = self._flush if flush_now else self._schedule_flush
+            try:
+                connection.ioloop.add_callback_threadsafe(callback)
+            except Exception:
+                pass # the connection is being replaced; queued messages are written once it reopens
+        return future
+
+    ## everything below runs on the publisher's own ioloop thread
+
+    def _run(self):
+        delay = publish_backoff
+        while True:
+            self.connection = pika.SelectConnection(
+                pika.ConnectionParameters(host=hostname, port=port, heartbeat=3600, blocked_connection_timeout=3600),
+                on_open_callback=self._on_open, on_open_error_callback=self._on_open_error,
+                on_close_callback=self._on_closed)
+            self.connection.ioloop.start()
+
+            if self.channel is not None:
+                delay = publish_backoff
+            self.channel = None
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+
+    def _on_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_open_error(self, connection, error):
+        print("AMQP Error:", error, flush=True)
+        connection.ioloop.stop()
+
+    def _on_closed(self, connection, reason):
+        print("AMQP confirm connection closed:", reason, flush=True)
+        self._fail_unconfirmed("connection closed before the broker confirmed the message: " + str(reason))
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.confirm_delivery(ack_nack_callback=self._on_confirm)
+        self.channel = channel
+        self.next_tag = 1
+        self.connection.ioloop.call_later(1, self._check_timeouts)
+        self._flush()
+
+    def _on_channel_closed(self, channel, reason):
+        if self.connection.is_open:
+            self.connection.close()
+
+    def _schedule_flush(self):
+        self.connection.ioloop.call_later(confirm_window_ms / 1000, self._flush)
+
+    def _flush(self):
+        with self.lock:
+            self.flush_scheduled = False
+            if self.channel is None or not self.channel.is_open:
+                return
+            batch = list(self.queued)
+            self.queued.clear()
+
+        now = time.monotonic()
+        for i, (future, exchange, routing_key, body, properties) in enumerate(batch):
+            if not self.channel.is_open:
+                # put back what was not written; it goes out once the channel is reopened
+                with self.lock:
+                    self.queued.extendleft(reversed(batch[i:]))
+                return
+            with self.lock:
+                self.unconfirmed[self.next_tag] = (future, now)
+                self.next_tag += 1
+            self.channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        with self.lock:
+            if method.multiple:
+                tags = [tag for tag in self.unconfirmed if tag <= method.delivery_tag]
+            else:
+                tags = [method.delivery_tag] if method.delivery_tag in self.unconfirmed else []
+            futures = [self.unconfirmed.pop(tag)[0] for tag in tags]
+            self.lock.notify_all()
+
+        for future in futures:
+            if acked:
+                future.set_result(True)
+            else:
+                future.set_exception(PublishNotConfirmed("the broker nacked the message"))
+
+    def _check_timeouts(self):
+        if self.channel is None:
+            return
+        now = time.monotonic()
+        with self.lock:
+            expired = [tag for tag, (_, written) in self.unconfirmed.items() if now - written > confirm_timeout]
+            futures = [self.unconfirmed.pop(tag)[0] for tag in expired]
+            if futures:
+                self.lock.notify_all()
+        for future in futures:
+            future.set_exception(PublishNotConfirmed("no confirm within " + str(confirm_timeout) + " seconds"))
+        self.connection.ioloop.call_later(1, self._check_timeouts)
+
+    def _fail_unconfirmed(self, message):
+        with self.lock:
+            futures = [future for future, _ in self.unconfirmed.values()]
+            self.unconfirmed.clear()
+            self.flush_scheduled = False
+            self.lock.notify_all()
+        for future in futures:
+            future.set_exception(PublishNotConfirmed(message))
+
+
+_confirming_publisher = None
+_confirming_publisher_lock = threading.Lock()
+
+
+def _get_confirming_publisher():
+    global _confirming_publisher
+
+    if _confirming_publisher is None:
+        with _confirming_publisher_lock:
+            if _confirming_publisher is None:
+                _confirming_publisher = ConfirmingPublisher()
+    return _confirming_publisher
+
+
+def log_unconfirmed(future):
+    # A ready-made publish callback that reports messages the broker did not confirm.
+    if future.exception() is not None:
+        print("AMQP publish not confirmed:", future.exception(), flush=True)
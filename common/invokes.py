@@ -1,30 +1,144 @@
+import asyncio
+import contextvars
+import copy
+import functools
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from os import environ
+from urllib.parse import urlsplit
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 SUPPORTED_HTTP_METHODS = set([
     "GET", "OPTIONS", "HEAD", "POST", "PUT", "PATCH", "DELETE"
 ])
 
-def invoke_http(url, method='GET', json=None, **kwargs):
+# Only these verbs are retried automatically; a retried POST/PATCH could apply twice downstream.
+IDEMPOTENT_HTTP_METHODS = frozenset([
+    "GET", "OPTIONS", "HEAD", "PUT", "DELETE"
+])
+
+# Connection pool settings, tunable per deployment through the environment.
+pool_connections = int(environ.get("INVOKE_POOL_CONNECTIONS", 10)) # number of host pools kept per session
+pool_maxsize = int(environ.get("INVOKE_POOL_MAXSIZE", 20)) # keep-alive connections kept per host
+connect_timeout = float(environ.get("INVOKE_CONNECT_TIMEOUT", 3.05)) # seconds
+read_timeout = float(environ.get("INVOKE_READ_TIMEOUT", 10)) # seconds
+max_retries = int(environ.get("INVOKE_MAX_RETRIES", 2)) # retries on idempotent verbs only
+retry_backoff = float(environ.get("INVOKE_RETRY_BACKOFF", 0.1)) # seconds, doubled after every retry
+many_concurrency = int(environ.get("INVOKE_MANY_CONCURRENCY", 10)) # default cap on in-flight calls of invoke_many
+
+# Circuit breaker settings, applied to every downstream host separately.
+breaker_window = float(environ.get("INVOKE_BREAKER_WINDOW", 30)) # seconds of calls considered for the failure rate
+breaker_min_calls = int(environ.get("INVOKE_BREAKER_MIN_CALLS", 10)) # calls needed in the window before the breaker may open
+breaker_failure_rate = float(environ.get("INVOKE_BREAKER_FAILURE_RATE", 0.5)) # failure ratio that opens the breaker
+breaker_open_seconds = float(environ.get("INVOKE_BREAKER_OPEN_SECONDS", 15)) # fast-fail time before a half-open probe
+
+# Single-flight: concurrent identical GETs share one upstream call. Off by default, as not every GET is a
+# plain lookup; call sites opt in with coalesce=True.
+coalesce_gets = environ.get("INVOKE_COALESCE_GETS", "0") == "1"
+
+# Opt-in response cache (cache= on invoke_http), bounded by the total size of the cached response bodies.
+cache_max_bytes = int(environ.get("INVOKE_CACHE_MAX_BYTES", 8 * 1024 * 1024))
+
+# Deadline propagation: the header carries the remaining budget of the request in milliseconds.
+DEADLINE_HEADER = "X-Request-Deadline"
+default_deadline_ms = int(environ.get("INVOKE_DEFAULT_DEADLINE_MS", 0)) # budget given to requests arriving without the header; 0 = none
+
+# One keep-alive session per downstream host ("scheme://host:port"), shared by all threads of the process.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# Worker threads that run the blocking calls of ainvoke_http; sized to the per-host pool.
+_executor = None
+_executor_lock = threading.Lock()
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+# In-flight coalesced GETs by key, and per-host counters of upstream calls made and calls collapsed onto them.
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+_coalesce_stats = {}
+
+# Cached GET results in least-recently-used order, and per-URL-pattern hit counters.
+_cache = OrderedDict()
+_cache_bytes = 0
+_cache_lock = threading.Lock()
+_cache_stats = {}
+
+# Absolute time.monotonic() by which the current request must be answered, or None.
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+def invoke_http(url, method='GET', json=None, coalesce=None, cache=None, **kwargs):
     """A simple wrapper for requests methods.
        url: the url of the http service;
        method: the http method;
        data: the JSON input when needed by the http method;
+       coalesce: share one upstream call among concurrent identical GETs (default: INVOKE_COALESCE_GETS);
+       cache: keep GET results in the in-process cache; True honours the Cache-Control/ETag headers
+            of the responder only, a number of seconds is used as the freshness when the responder gives none;
        return: the JSON reply content from the http service if the call succeeds;
             otherwise, return a JSON object with a "code" name-value pair.
     """
+    is_get = method.upper() == "GET"
+    invoke = lambda: _invoke(url, method, json, **kwargs)
+
+    if cache and is_get and json is None:
+        cache_key = (url, repr(sorted(kwargs.items())))
+        entry = _cache_lookup(cache_key)
+        if entry is not None and entry.expires > time.monotonic():
+            _count_cache(url, "hits")
+            return copy.deepcopy(entry.result)
+        invoke = lambda: _revalidate(cache_key, entry, cache, url, **kwargs)
+
+    if coalesce is None:
+        coalesce = coalesce_gets
+    if coalesce and is_get:
+        key = (url, repr(json), repr(sorted(kwargs.items())))
+        return _single_flight(key, url, invoke)
+    return invoke()
+
+
+def _invoke(url, method, json, **kwargs):
+    return _send(url, method, json, **kwargs)[0]
+
+
+def _send(url, method, json, **kwargs):
+    # Make the call; return the result together with the raw response (None when no response came back).
     code = 200
     result = {}
 
+    remaining = remaining_deadline()
+    if remaining is not None:
+        if remaining <= 0:
+            return {"code": 504, "message": "invocation of service skipped, request deadline exceeded: " + url + "."}, None
+        # Pass the shrunk budget on and never wait past it.
+        kwargs["headers"] = dict(kwargs.get("headers") or {}, **{DEADLINE_HEADER: str(int(remaining * 1000))})
+        kwargs.setdefault("timeout", (min(connect_timeout, remaining), min(read_timeout, remaining)))
+
+    breaker = get_breaker(url)
+    if not breaker.allow():
+        return {"code": 503, "message": "invocation of service skipped, circuit open: " + url + "."}, None
+
     try:
         if method.upper() in SUPPORTED_HTTP_METHODS:
-            r = requests.request(method, url, json = json, **kwargs)
+            kwargs.setdefault("timeout", (connect_timeout, read_timeout))
+            r = get_session(url).request(method, url, json = json, **kwargs)
         else:
             raise Exception("HTTP method {} unsupported.".format(method))
     except Exception as e:
         code = 500
         result = {"code": code, "message": "invocation of service fails: " + url + ". " + str(e)}
     if code not in range(200,300):
-        return result
+        breaker.record(False)
+        return result, None
+    breaker.record(r.status_code < 500)
 
     ## Check http call result
     if r.status_code != requests.codes.ok:
@@ -35,5 +149,374 @@ def invoke_http(url, method='GET', json=None, **kwargs):
         code = 500
         result = {"code": code, "message": "Invalid JSON output from service: " + url + ". " + str(e)}
 
+    return result, r
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+def _single_flight(key, url, invoke):
+    # The first caller of a key makes the upstream call; callers arriving while it is in flight wait for it.
+    with _in_flight_lock:
+        call = _in_flight.get(key)
+        leader = call is None
+        if leader:
+            call = _Call()
+            _in_flight[key] = call
+        stats = _coalesce_stats.setdefault(_host_of(url), {"calls": 0, "collapsed": 0})
+        stats["calls" if leader else "collapsed"] += 1
+
+    if not leader:
+        # a follower waits no longer than its own deadline allows, however long the leader takes
+        remaining = remaining_deadline()
+        if not call.done.wait(None if remaining is None else max(remaining, 0)):
+            return {"code": 504, "message": "invocation of service abandoned, request deadline exceeded: " + url + "."}
+        # Every caller gets its own copy, as callers are free to modify the result they are given.
+        return copy.deepcopy(call.result)
+
+    result = {"code": 500, "message": "invocation of service fails: " + url + "."}
+    try:
+        result = invoke()
+    finally:
+        call.result = copy.deepcopy(result)
+        with _in_flight_lock:
+            del _in_flight[key]
+        call.done.set()
+    return result
+
+
+def get_coalesce_stats():
+    """Single-flight counters of this process, per downstream host.
+       calls: GETs that went upstream;
+       collapsed: GETs that were answered with the result of an identical call already in flight.
+    """
+    with _in_flight_lock:
+        return copy.deepcopy(_coalesce_stats)
+
+
+class _CacheEntry:
+    def __init__(self, result, etag, expires, size):
+        self.result = result
+        self.etag = etag
+        self.expires = expires
+        self.size = size
+
+
+def _revalidate(key, entry, cache, url, **kwargs):
+    # Fetch the url, conditionally when a stale entry with an ETag is held, and refresh the cache.
+    if entry is not None and entry.etag:
+        kwargs["headers"] = dict(kwargs.get("headers") or {}, **{"If-None-Match": entry.etag})
+    result, r = _send(url, "GET", None, **kwargs)
+
+    if r is not None and r.status_code == 304 and entry is not None:
+        freshness = _freshness(r.headers, cache, entry.etag)
+        entry.expires = time.monotonic() + (freshness or 0)
+        _count_cache(url, "revalidated")
+        return copy.deepcopy(entry.result)
+
+    _count_cache(url, "misses")
+    if r is not None and r.status_code == 200 and isinstance(result, dict) and result.get("code") in range(200, 300):
+        etag = r.headers.get("ETag")
+        freshness = _freshness(r.headers, cache, etag)
+        if freshness is not None:
+            _cache_store(key, _CacheEntry(copy.deepcopy(result), etag, time.monotonic() + freshness, len(r.content)))
     return result
 
+
+def _freshness(headers, cache, etag):
+    # Seconds the response may be served from the cache; None when it must not be stored at all.
+    directives = {}
+    for directive in headers.get("Cache-Control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        directives[name.lower()] = value.strip('"')
+
+    if "no-store" in directives:
+        return None
+    if "no-cache" in directives:
+        return 0
+    if directives.get("max-age", "").isdigit():
+        return int(directives["max-age"])
+    if cache is True:
+        # No freshness given: keep it only when it can be revalidated cheaply.
+        return 0 if etag else None
+    return float(cache)
+
+
+def _cache_lookup(key):
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None:
+            _cache.move_to_end(key)
+        return entry
+
+
+def _cache_store(key, entry):
+    global _cache_bytes
+
+    if entry.size > cache_max_bytes:
+        return
+    with _cache_lock:
+        old = _cache.pop(key, None)
+        if old is not None:
+            _cache_bytes -= old.size
+        _cache[key] = entry
+        _cache_bytes += entry.size
+        while _cache_bytes > cache_max_bytes:
+            _, evicted = _cache.popitem(last=False)
+            _cache_bytes -= evicted.size
+
+
+def _url_pattern(url):
+    # Group urls that differ only by ids, e.g. http://verification:6001/verification/mission/<id>.
+    return re.sub(r"/\d+(?=/|$)", "/<id>", url.split("?")[0])
+
+
+def _count_cache(url, outcome):
+    with _cache_lock:
+        stats = _cache_stats.setdefault(_url_pattern(url), {"hits": 0, "revalidated": 0, "misses": 0})
+        stats[outcome] += 1
+
+
+def get_cache_stats():
+    """Response cache counters of this process, per URL pattern.
+       hits: answered from a fresh entry; revalidated: answered from a stale entry after a 304;
+       misses: fetched in full; hit_rate: share of calls answered without a full fetch.
+    """
+    with _cache_lock:
+        stats = copy.deepcopy(_cache_stats)
+        size = _cache_bytes
+    for pattern_stats in stats.values():
+        total = pattern_stats["hits"] + pattern_stats["revalidated"] + pattern_stats["misses"]
+        pattern_stats["hit_rate"] = (pattern_stats["hits"] + pattern_stats["revalidated"]) / total if total else 0
+    return {"bytes": size, "patterns": stats}
+
+
+def cacheable(max_age):
+    """Decorator for Flask routes whose successful replies may be cached by callers for max_age seconds.
+       Adds Cache-Control and ETag headers, and answers a matching If-None-Match with a 304.
+    """
+    from flask import make_response, request
+
+    def decorator(route):
+        @functools.wraps(route)
+        def wrapper(*args, **kwargs):
+            response = make_response(route(*args, **kwargs))
+            body = response.get_json(silent=True)
+            if response.status_code != 200 or (isinstance(body, dict) and body.get("code") not in range(200, 300)):
+                return response
+
+            response.cache_control.max_age = max_age
+            response.add_etag()
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
+
+
+async def ainvoke_http(url, method='GET', json=None, **kwargs):
+    """The asyncio companion of invoke_http; same arguments and same return contract.
+       The call runs on the pooled sessions from a worker thread, so it can be awaited
+       together with other calls without blocking the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    # Run in a copy of the caller's context so the request deadline follows the call.
+    call = functools.partial(contextvars.copy_context().run, invoke_http, url, method, json, **kwargs)
+    return await loop.run_in_executor(_get_executor(), call)
+
+
+async def invoke_many(calls, concurrency=None):
+    """Run several invoke_http calls concurrently.
+       calls: a list of dicts holding the invoke_http arguments, e.g. {"url": ..., "method": "PATCH", "json": {...}};
+       concurrency: the maximum number of calls in flight at once;
+       return: the list of results, in the same order as calls.
+    """
+    semaphore = asyncio.Semaphore(concurrency or many_concurrency)
+
+    async def bounded(call):
+        async with semaphore:
+            return await ainvoke_http(**call)
+
+    return await asyncio.gather(*[bounded(call) for call in calls])
+
+
+def _get_executor():
+    global _executor
+
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=pool_maxsize, thread_name_prefix="invoke_http")
+    return _executor
+
+
+def get_session(url):
+    # Return the pooled session for the host of the url, creating it on first use.
+    host = _host_of(url)
+
+    session = _sessions.get(host)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(host)
+            if session is None:
+                session = _new_session()
+                _sessions[host] = session
+    return session
+
+
+def _host_of(url):
+    parts = urlsplit(url)
+    return parts.scheme + "://" + parts.netloc
+
+
+def _new_session():
+    retry = Retry(
+        total=max_retries, connect=max_retries, read=max_retries,
+        status_forcelist=(502, 503, 504), allowed_methods=IDEMPOTENT_HTTP_METHODS,
+        backoff_factor=retry_backoff, raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_pool_stats():
+    """Connection pool counters of this process, per downstream host.
+       requests: number of requests sent to the host;
+       hits: requests that reused a kept-alive connection;
+       misses: requests that had to open a new connection.
+    """
+    stats = {}
+    with _sessions_lock:
+        sessions = list(_sessions.items())
+
+    for host, session in sessions:
+        requests_sent = 0
+        connections_opened = 0
+        for adapter in set(session.adapters.values()):
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is None:
+                    continue
+                requests_sent += pool.num_requests
+                connections_opened += pool.num_connections
+        stats[host] = {
+            "requests": requests_sent,
+            "hits": max(requests_sent - connections_opened, 0),
+            "misses": connections_opened
+        }
+    return stats
+
+
+class CircuitBreaker:
+    """Failure-rate circuit breaker for one downstream host.
+       closed: calls go through while the failure rate over the window stays below the threshold;
+       open: calls fail fast until breaker_open_seconds have passed;
+       half-open: a single probe call decides between closed and open again.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, host):
+        self.host = host
+        self.state = self.CLOSED
+        self.opened_at = 0
+        self.calls = deque() # (time, success) of the calls made within the window
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= breaker_open_seconds:
+                # Let exactly one probe through; the others keep failing fast until it returns.
+                self.state = self.HALF_OPEN
+                return True
+            return self.state == self.CLOSED
+
+    def record(self, success):
+        with self.lock:
+            now = time.monotonic()
+            if self.state == self.HALF_OPEN:
+                self.calls.clear()
+                if success:
+                    self.state = self.CLOSED
+                else:
+                    self.state = self.OPEN
+                    self.opened_at = now
+                return
+
+            self.calls.append((now, success))
+            while self.calls and now - self.calls[0][0] > breaker_window:
+                self.calls.popleft()
+
+            failures = sum(1 for _, ok in self.calls if not ok)
+            if len(self.calls) >= breaker_min_calls and failures / len(self.calls) >= breaker_failure_rate:
+                self.state = self.OPEN
+                self.opened_at = now
+
+    def stats(self):
+        with self.lock:
+            return {
+                "state": self.state,
+                "calls": len(self.calls),
+                "failures": sum(1 for _, ok in self.calls if not ok)
+            }
+
+
+def get_breaker(url):
+    host = _host_of(url)
+
+    breaker = _breakers.get(host)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(host)
+            if breaker is None:
+                breaker = CircuitBreaker(host)
+                _breakers[host] = breaker
+    return breaker
+
+
+def get_breaker_stats():
+    with _breakers_lock:
+        breakers = list(_breakers.items())
+    return {host: breaker.stats() for host, breaker in breakers}
+
+
+def remaining_deadline():
+    # Seconds left before the deadline of the current request, or None when it has no deadline.
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def propagate_deadline(app):
+    """Make a Flask app honour the X-Request-Deadline header.
+       The budget of an incoming request is kept for its lifetime, so every invoke_http made
+       while serving it forwards the remaining budget; a request that arrives with its
+       budget already spent is answered with a 504 straight away.
+    """
+    from flask import request, jsonify
+
+    @app.before_request
+    def start_deadline():
+        budget_ms = request.headers.get(DEADLINE_HEADER, type=int)
+        if budget_ms is None and default_deadline_ms > 0:
+            budget_ms = default_deadline_ms
+        if budget_ms is None:
+            return None
+
+        if budget_ms <= 0:
+            return jsonify({
+                "code": 504,
+                "message": "Request deadline exceeded."
+            }), 504
+        _deadline.set(time.monotonic() + budget_ms / 1000)
+
+    @app.teardown_request
+    def end_deadline(exc):
+        _deadline.set(None)
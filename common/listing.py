@@ -0,0 +1,115 @@
+from datetime import date, datetime
+from os import environ
+
+# Keyset pagination for the list endpoints: ?after=<key of the last row seen>&limit=<page size>,
+# plus equality filters on the columns a service allows. Pages are ordered by the key column,
+# so each page is one index range scan however deep the client has paged.
+
+default_limit = int(environ.get("LISTING_DEFAULT_LIMIT", 100)) # rows per page when no limit is asked for
+max_limit = int(environ.get("LISTING_MAX_LIMIT", 1000)) # hard cap on rows per page
+stream_batch_size = int(environ.get("LISTING_STREAM_BATCH_SIZE", 500)) # rows read per query when streaming
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+
+class ListingError(Exception):
+    pass
+
+
+def paginate(query, key_column, filters=None, args=None):
+    """Returns (rows, next_cursor) for one page of query.
+       key_column: the unique column the pages are ordered and split by (usually the primary key);
+       filters: {query parameter name: column} allowed as ?name=value equality filters;
+       args: the query parameters, the current request's by default;
+       next_cursor is the value to pass as ?after= for the next page, None on the last page.
+    """
+    if args is None:
+        from flask import request
+        args = request.args
+
+    try:
+        limit = int(args.get("limit", default_limit))
+    except ValueError:
+        raise ListingError("limit must be a whole number")
+    if limit < 1:
+        raise ListingError("limit must be at least 1")
+    limit = min(limit, max_limit)
+
+    query = _filter(query, key_column, filters, args)
+
+    rows = query.order_by(key_column).limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, getattr(rows[-1], key_column.key)
+    return rows, None
+
+
+def wants_stream():
+    """True when the client asked for the whole collection as NDJSON (Accept header or ?stream=1)."""
+    from flask import request
+    return request.args.get("stream") == "1" or \
+        any(mimetype == NDJSON_MIMETYPE for mimetype, quality in request.accept_mimetypes if quality)
+
+
+def stream_rows(query, key_column, filters=None, args=None):
+    """Streams every row of query (after the same ?after= and filters as paginate) as one JSON object
+       per line. Rows are read by key ranges of stream_batch_size, one indexed query each, so memory
+       stays flat and the first rows go out before the last are read.
+    """
+    from flask import Response, current_app, request, stream_with_context
+    if args is None:
+        args = request.args
+
+    # keyset chunks rather than yield_per: mysql-connector buffers the whole result of a query client-side
+    query = _filter(query, key_column, filters, args)
+    dumps = current_app.json.dumps
+
+    def generate():
+        chunk = query
+        while True:
+            rows = chunk.order_by(key_column).limit(stream_batch_size).all()
+            for row in rows:
+                yield dumps(row.json()) + "\n"
+            if len(rows) < stream_batch_size:
+                return
+            chunk = query.filter(key_column > getattr(rows[-1], key_column.key))
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+
+def _filter(query, key_column, filters, args):
+    for name, column in (filters or {}).items():
+        if name in args:
+            query = query.filter(column == _parse(column, name, args[name]))
+
+    if "after" in args:
+        query = query.filter(key_column > _parse(key_column, "after", args["after"]))
+    return query
+
+
+def _parse(column, name, value):
+    python_type = column.type.python_type
+    try:
+        if python_type is bool:
+            if value.lower() not in ("1", "0", "true", "false"):
+                raise ValueError(value)
+            return value.lower() in ("1", "true")
+        if python_type in (date, datetime):
+            return python_type.fromisoformat(value)
+        return python_type(value)
+    except ValueError:
+        raise ListingError("Invalid value for " + name + ": " + value)
+
+
+def handle_listing_errors(app):
+    # a bad ?after=, ?limit= or filter value is the client's mistake: answer 400 in the usual envelope
+    from flask import jsonify
+
+    @app.errorhandler(ListingError)
+    def listing_error(error):
+        return jsonify(
+            {
+                "code": 400,
+                "message": str(error)
+            }
+        ), 400
@@ -0,0 +1,183 @@
+import json
+import zlib
+from os import environ
+
+import msgpack
+import pika
+
+# Every AMQP payload is one of the message classes below, encoded as a MessagePack map
+# {"v": version, "type": type, ...fields}, deflated when it is larger than the threshold.
+# Messages published before the codec existed are plain JSON without "v" and are still decoded.
+
+MESSAGE_VERSION = 1
+CONTENT_TYPE_MSGPACK = "application/x-msgpack"
+CONTENT_TYPE_JSON = "application/json"
+CONTENT_ENCODING_DEFLATE = "deflate"
+
+compress_threshold = int(environ.get("MESSAGE_COMPRESS_THRESHOLD", 1024)) # bytes; larger payloads are deflated
+
+# type -> message class, filled in by @message_type
+message_types = {}
+
+
+class MessageError(Exception):
+    pass
+
+
+def message_type(cls):
+    message_types[cls.type] = cls
+    return cls
+
+
+class Message:
+    type = None
+    fields = ()
+    optional_fields = ("idempotency_key",)
+
+    def __init__(self, **values):
+        missing = [field for field in self.fields if field not in values]
+        if missing:
+            raise MessageError(self.type + " message is missing " + ", ".join(missing))
+        for field in self.fields + self.optional_fields:
+            setattr(self, field, values.get(field))
+
+    def json(self):
+        dto = {"v": MESSAGE_VERSION, "type": self.type}
+        for field in self.fields + self.optional_fields:
+            value = getattr(self, field)
+            if value is not None:
+                dto[field] = value
+        return dto
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{field: data[field] for field in cls.fields + cls.optional_fields if field in data})
+
+    def __repr__(self):
+        return self.__class__.__name__ + repr(self.json())
+
+
+############   Notification messages    #############
+
+@message_type
+class Email(Message):
+    type = "email"
+    fields = ("first_name", "email")
+
+
+@message_type
+class Completion(Message):
+    type = "completion"
+    fields = ("mission_name", "first_name", "phone_number", "award_points")
+
+
+@message_type
+class Redeem(Message):
+    type = "redeem"
+    fields = ("reward_name", "first_name", "phone_number", "redemption_code")
+
+
+@message_type
+class Inform(Message):
+    type = "inform"
+    fields = ("number_pax", "first_name", "phone_number")
+
+
+@message_type
+class Icebreakers(Message):
+    type = "icebreakers"
+    fields = ("icebreaker_id", "statements", "first_name", "phone_number")
+
+    @classmethod
+    def from_dict(cls, data):
+        if "icebreakers" in data:
+            # old payloads embedded the whole icebreakers response
+            try:
+                data = dict(data, icebreaker_id=data["icebreakers"]["id"], statements=data["icebreakers"]["statements"])
+            except (KeyError, TypeError) as e:
+                raise MessageError("Malformed legacy icebreakers message: " + repr(e))
+        return super().from_dict(data)
+
+
+@message_type
+class QueueTicket(Message):
+    type = "queueticket"
+    fields = ("account_id", "queue_id", "payment_method", "first_name", "phone_number")
+
+
+@message_type
+class UseQueue(Message):
+    type = "use_queue"
+    fields = ("account_id", "queue_id", "payment_method", "first_name", "phone_number")
+
+
+@message_type
+class Promo(Message):
+    type = "promo"
+    fields = ("account_id", "promo_code", "first_name", "phone_number")
+
+
+############   Challenge messages    #############
+
+@message_type
+class ChallengeComplete(Message):
+    type = "challenge_complete"
+    fields = ("code", "mission_id", "account_ids")
+
+    @classmethod
+    def from_dict(cls, data):
+        if "account_ids" not in data:
+            # old payloads carried the created group or queue ticket instead of the accounts
+            try:
+                if "group_obj" in data:
+                    account_ids = list(data["group_obj"]["list_account"])
+                else:
+                    account_ids = [data["account_id"]] if "account_id" in data else []
+            except (KeyError, TypeError) as e:
+                raise MessageError("Malformed legacy challenge_complete message: " + repr(e))
+            data = dict(data, account_ids=account_ids)
+        return super().from_dict(data)
+
+
+############   Codec    #############
+
+def encode(message):
+    """Returns (body, properties) to publish the message with."""
+    body = msgpack.packb(message.json(), use_bin_type=True)
+    content_encoding = None
+    if len(body) > compress_threshold:
+        body = zlib.compress(body)
+        content_encoding = CONTENT_ENCODING_DEFLATE
+
+    properties = pika.BasicProperties(
+        content_type=CONTENT_TYPE_MSGPACK, content_encoding=content_encoding,
+        type=message.type, delivery_mode=2)
+    return body, properties
+
+
+def decode(body, properties=None, default_type=None):
+    """Returns the message class instance for a received body.
+       default_type names the type of old JSON payloads that did not say theirs.
+    """
+    content_type = getattr(properties, "content_type", None)
+    content_encoding = getattr(properties, "content_encoding", None)
+
+    try:
+        if content_encoding == CONTENT_ENCODING_DEFLATE:
+            body = zlib.decompress(body)
+        if content_type == CONTENT_TYPE_MSGPACK:
+            data = msgpack.unpackb(body, raw=False)
+        else:
+            data = json.loads(body)
+    except (ValueError, zlib.error) as e:
+        raise MessageError("Undecodable message: " + str(e))
+
+    if not isinstance(data, dict):
+        raise MessageError("Message is not a map: " + repr(data))
+
+    cls = message_types.get(data.get("type", default_type))
+    if cls is None:
+        raise MessageError("Unknown message type: " + repr(data.get("type", default_type)))
+    if data.get("v", 0) > MESSAGE_VERSION:
+        raise MessageError(cls.type + " message version " + str(data["v"]) + " is newer than this service understands")
+    return cls.from_dict(data)
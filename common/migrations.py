@@ -0,0 +1,76 @@
+from os import environ
+
+from sqlalchemy import Column, Integer, MetaData, Table, inspect, select, text
+
+# Each service keeps an ordered MIGRATIONS list; the database records how many have been applied in its
+# schema_version table. At startup verify_schema applies the missing ones (AUTO_MIGRATE=1, the default)
+# or refuses to start on an out-of-date schema, so an up-to-date database costs one SELECT and no DDL.
+# Migrations are append-only: never edit or reorder one that has shipped.
+
+auto_migrate = environ.get("AUTO_MIGRATE", "1") == "1"
+
+_metadata = MetaData()
+schema_version = Table("schema_version", _metadata, Column("version", Integer, nullable=False))
+
+
+class SchemaError(Exception):
+    pass
+
+
+def verify_schema(db, migrations):
+    """Brings the service database up to len(migrations), or checks it is there. Call inside the app context."""
+    with db.engine.begin() as connection:
+        schema_version.create(connection, checkfirst=True)
+        version = connection.execute(select(schema_version.c.version)).scalar()
+        if version is None:
+            version = 0
+            connection.execute(schema_version.insert().values(version=0))
+
+    if version > len(migrations):
+        raise SchemaError("Database schema is at version " + str(version) + ", newer than this service (" + str(len(migrations)) + ")")
+    if version == len(migrations):
+        return
+    if not auto_migrate:
+        raise SchemaError("Database schema is at version " + str(version) + ", expected " + str(len(migrations)) + "; run the migrations")
+
+    for number in range(version + 1, len(migrations) + 1):
+        with db.engine.begin() as connection:
+            migrations[number - 1](connection)
+            connection.execute(schema_version.update().values(version=number))
+        print("Applied migration", number, "of", len(migrations), flush=True)
+
+
+############   Migration steps    #############
+# Every step checks the live schema first, so it is safe on databases that already have the change.
+
+def create_tables(db):
+    # the tables of the service's models that do not exist yet
+    def step(connection):
+        db.metadata.create_all(connection)
+    return step
+
+
+def create_index(table, name, columns, unique=False):
+    def step(connection):
+        for index in inspect(connection).get_indexes(table):
+            if index["name"] == name or (list(index["column_names"]) == list(columns) and bool(index["unique"]) == unique):
+                return
+        connection.execute(text("CREATE " + ("UNIQUE " if unique else "") + "INDEX " + name +
+                                " ON " + table + " (" + ", ".join(columns) + ")"))
+    return step
+
+
+def add_column(table, name, ddl):
+    # ddl: the column definition, e.g. "INTEGER NOT NULL DEFAULT 0"
+    def step(connection):
+        if name in [column["name"] for column in inspect(connection).get_columns(table)]:
+            return
+        connection.execute(text("ALTER TABLE " + table + " ADD COLUMN " + name + " " + ddl))
+    return step
+
+
+def run_sql(statement):
+    # a data change, e.g. a backfill; the statement itself must be safe to run again
+    def step(connection):
+        connection.execute(text(statement))
+    return step
@@ -2,10 +2,17 @@ from flask import Flask, redirect, request, jsonify, url_for
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from os import environ
-from datetime import datetime
-import asyncio
+from datetime import datetime, timedelta
+from sqlalchemy import or_
+import itertools
+import random
+import threading
+import time
 import stripe
 
+from listing import paginate, stream_rows, wants_stream, handle_listing_errors
+from migrations import verify_schema, create_tables, create_index, add_column
+
 app = Flask(__name__)
 app.config['JSON_SORT_KEYS'] = False
 app.config['SQLALCHEMY_DATABASE_URI'] = environ.get('dbURL')
@@ -15,10 +22,131 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_recycle': 299}
 db = SQLAlchemy(app)
 
 CORS(app)
+handle_listing_errors(app)
 
 stripe.api_key = environ.get('STRIPE_API_KEY')
+payment_gateway = environ.get("PAYMENT_GATEWAY", "stripe") # "stripe", or "fake" for offline load tests
+fake_latency_ms = int(environ.get("FAKE_GATEWAY_LATENCY_MS", 0)) # added to every fake gateway call
+fake_jitter_ms = int(environ.get("FAKE_GATEWAY_JITTER_MS", 0)) # up to this much more, drawn from the seeded generator
+fake_failure_rate = float(environ.get("FAKE_GATEWAY_FAILURE_RATE", 0)) # fraction of fake gateway calls that fail
+fake_pay_after = float(environ.get("FAKE_GATEWAY_PAY_AFTER", 0)) # seconds after creation a fake session reads as paid
+fake_seed = int(environ.get("FAKE_GATEWAY_SEED", 0)) # same seed, same sequence of latencies and failures
+webhook_secret = environ.get('STRIPE_WEBHOOK_SECRET') # signing secret of the Stripe webhook endpoint
+
+reconcile_interval = int(environ.get("EPAYMENT_RECONCILE_INTERVAL", 5)) # seconds between reconciliation passes
+reconcile_batch_size = int(environ.get("EPAYMENT_RECONCILE_BATCH_SIZE", 50)) # unpaid sessions checked per pass
+reconcile_base_delay = int(environ.get("EPAYMENT_RECONCILE_BASE_DELAY", 5)) # seconds before a session's first check; doubles after each
+reconcile_max_delay = int(environ.get("EPAYMENT_RECONCILE_MAX_DELAY", 600)) # cap on the delay between checks of one session
 
 order_URL = environ.get('orderURL') or "http://localhost:6201/order/"
+status_URL = environ.get('epaymentStatusURL') or "http://localhost:6203/epayment/check_payment_status/"
+cancel_URL = environ.get('epaymentCancelURL') or "http://localhost:5174/payment-mode"
+
+
+############   Payment gateways    #############
+# The service talks to the payment provider only through a gateway: create_session and retrieve_session
+# both return a CheckoutSession, and raise GatewayError (SessionNotFound for an unknown id).
+
+class GatewayError(Exception):
+    pass
+
+
+class SessionNotFound(GatewayError):
+    pass
+
+
+class CheckoutSession:
+    def __init__(self, id, url, payment_status, status):
+        self.id = id
+        self.url = url
+        self.payment_status = payment_status # "unpaid", "paid" or "no_payment_required"
+        self.status = status # "open", "complete" or "expired"
+
+
+class StripeGateway:
+    price = 'price_1MjeeeExUYBuMhthqO8FblZr'
+
+    def create_session(self, account_id):
+        try:
+            # the create response already carries the url and payment status: no retrieve needed
+            session = stripe.checkout.Session.create(
+                line_items=[
+                    {
+                        'price': self.price,
+                        'quantity': 1
+                    }
+                ],
+                mode="payment",
+                success_url=status_URL + '{CHECKOUT_SESSION_ID}',
+                cancel_url=cancel_URL
+            )
+        except stripe.error.StripeError as e:
+            raise GatewayError(str(e))
+        return self.checkout_session(session)
+
+    def retrieve_session(self, session_id):
+        try:
+            session = stripe.checkout.Session.retrieve(session_id)
+        except stripe.error.InvalidRequestError as e:
+            # only a missing session settles the payment as failed; any other bad request is retried
+            if e.code == "resource_missing":
+                raise SessionNotFound(str(e))
+            raise GatewayError(str(e))
+        except stripe.error.StripeError as e:
+            raise GatewayError(str(e))
+        return self.checkout_session(session)
+
+    @staticmethod
+    def checkout_session(session):
+        return CheckoutSession(session.id, session.url, session.payment_status, session.status)
+
+
+class FakeGateway:
+    """In-process stand-in for Stripe, so the checkout flow can be load-tested on one machine.
+       Latency and failures come from one generator seeded with fake_seed, so a run can be repeated;
+       a session reads as paid fake_pay_after seconds after it was created.
+    """
+    def __init__(self, latency_ms, jitter_ms, failure_rate, pay_after, seed):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.pay_after = pay_after
+        self.random = random.Random(seed)
+        self.ids = itertools.count(1)
+        self.sessions = {} # id -> creation time
+        self.lock = threading.Lock()
+
+    def call(self):
+        with self.lock:
+            delay = self.latency_ms + self.random.uniform(0, self.jitter_ms)
+            failed = self.random.random() < self.failure_rate
+        if delay:
+            time.sleep(delay / 1000)
+        if failed:
+            raise GatewayError("Injected fake gateway failure")
+
+    def create_session(self, account_id):
+        self.call()
+        with self.lock:
+            session_id = "cs_fake_" + str(next(self.ids))
+            self.sessions[session_id] = time.monotonic()
+        return CheckoutSession(session_id, status_URL + session_id, "unpaid", "open")
+
+    def retrieve_session(self, session_id):
+        self.call()
+        created = self.sessions.get(session_id)
+        if created is None:
+            raise SessionNotFound("No such checkout session: " + session_id)
+        if time.monotonic() - created < self.pay_after:
+            return CheckoutSession(session_id, status_URL + session_id, "unpaid", "open")
+        return CheckoutSession(session_id, None, "paid", "complete")
+
+
+gateways = {
+    "stripe": StripeGateway,
+    "fake": lambda: FakeGateway(fake_latency_ms, fake_jitter_ms, fake_failure_rate, fake_pay_after, fake_seed),
+}
+gateway = gateways[payment_gateway]()
 
 class epayment(db.Model):
     __tablename__ = 'epayment'
@@ -29,6 +157,8 @@ class epayment(db.Model):
     status = db.Column(db.String(64), nullable=False)
     price = db.Column(db.Float, nullable=False)
     paymentDate = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    check_attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_check = db.Column(db.DateTime, nullable=True)
 
     def __init__(self, session_id, checkout_url, account_id, status, price, paymentDate):
         self.session_id = session_id
@@ -37,6 +167,8 @@ class epayment(db.Model):
         self.status = status
         self.price = price
         self.paymentDate = paymentDate
+        self.check_attempts = 0
+        self.next_check = paymentDate + timedelta(seconds=reconcile_base_delay)
 
     def json(self):
         return {"session_id": self.session_id,
@@ -46,85 +178,209 @@ class epayment(db.Model):
                 "paymentDate": self.paymentDate
                 }
 
+# schema changes, in order; see common/migrations.py
+MIGRATIONS = [
+    create_tables(db),
+    create_index("epayment", "epayment_account", ["account_id"]),
+    create_index("epayment", "epayment_status", ["status"]),
+    add_column("epayment", "check_attempts", "INTEGER NOT NULL DEFAULT 0"),
+    add_column("epayment", "next_check", "DATETIME NULL"),
+    create_index("epayment", "epayment_status_next_check", ["status", "next_check"]),
+]
+
 with app.app_context():
-    db.create_all()
+    verify_schema(db, MIGRATIONS)
 
 @app.route('/epayment/create_checkout_session', methods=['POST'])
 def create_checkout_session():
     data = request.get_json()
     try:
-        session_id = ''
-        checkout = ''
-        payment_status = ''
-        checkout_session = stripe.checkout.Session.create(
-
-            line_items=[
-                {
-                    'price': 'price_1MjeeeExUYBuMhthqO8FblZr',
-                    'quantity': 1
-                }
-            ],
-            mode="payment",
-            success_url='http://localhost:6203/epayment/check_payment_status/{CHECKOUT_SESSION_ID}',
-            cancel_url='http://localhost:5174/payment-mode'
-        )
-        session_id = checkout_session.id
-        session = stripe.checkout.Session.retrieve(session_id)
-        checkout = session["url"]
-        payment_status = session.payment_status
-    except Exception as e:
-        return str(e)
-    payment = epayment(session_id=session_id, checkout_url=checkout,
-                       account_id=data["account_id"], status=payment_status, price=8, paymentDate=datetime.now())
+        session = gateway.create_session(data["account_id"])
+    except GatewayError as e:
+        return jsonify(
+            {
+                "code": 502,
+                "message": "Could not create the checkout session: " + str(e)
+            }
+        ), 502
+    payment = epayment(session_id=session.id, checkout_url=session.url,
+                       account_id=data["account_id"], status=session.payment_status, price=8, paymentDate=datetime.now())
     db.session.add(payment)
     db.session.commit()
     return jsonify({
-        "checkout_url": checkout
-    }), 303
+        "code": 201,
+        "checkout_url": session.url
+    }), 201
 
 
-@app.route('/epayment/check_payment_status/<session_id>', methods=['GET'])
-async def check_payment_status(session_id):
+############   Payment status    #############
+# A payment leaves "unpaid" exactly once, through settle_payment: either Stripe tells us with a webhook,
+# or the reconciler finds out by polling the session. The browser-facing endpoint only reads the table.
+
+def session_outcome(session):
+    # the final status of a checkout session, or None while the customer can still pay
+    if session.payment_status in ("paid", "no_payment_required"):
+        return "paid"
+    if session.status == "expired":
+        return "expired"
+    return None
+
+
+def settle_payment(session_id, status):
+    # conditional on "unpaid", so a late webhook or poll cannot overwrite an outcome already recorded
+    settled = epayment.query.filter(epayment.session_id == session_id, epayment.status == "unpaid").update(
+        {epayment.status: status, epayment.next_check: None}, synchronize_session=False)
+    db.session.commit()
+    if settled:
+        print("Payment", session_id, "is", status, flush=True)
+    return settled
+
+
+reconcile_wakeup = threading.Event()
+
+
+def reconcile_payments():
+    # polls the sessions no webhook has settled yet; the webhook is the fast path, this is the safety net
+    while True:
+        reconcile_wakeup.wait(reconcile_interval)
+        reconcile_wakeup.clear()
+        try:
+            with app.app_context():
+                while reconcile_payments_once() == reconcile_batch_size:
+                    pass
+        except Exception as e:
+            print("Payment reconciliation failed:", e, flush=True)
+
+
+def reconcile_payments_once():
+    now = datetime.now()
+    due = epayment.query.filter(epayment.status == "unpaid", or_(
+        epayment.next_check == None, epayment.next_check <= now)).order_by(
+        epayment.next_check).limit(reconcile_batch_size).all()
+
+    for payment in due:
+        try:
+            outcome = session_outcome(gateway.retrieve_session(payment.session_id))
+        except SessionNotFound:
+            outcome = "failed"
+        except GatewayError as e:
+            print("Could not check payment", payment.session_id, ":", e, flush=True)
+            outcome = None
+
+        if outcome:
+            settle_payment(payment.session_id, outcome)
+            continue
+        # still open: check again later, backing off exponentially up to reconcile_max_delay
+        delay = min(reconcile_base_delay * 2 ** payment.check_attempts, reconcile_max_delay)
+        epayment.query.filter(epayment.session_id == payment.session_id, epayment.status == "unpaid").update(
+            {epayment.check_attempts: payment.check_attempts + 1,
+             epayment.next_check: now + timedelta(seconds=delay)}, synchronize_session=False)
+        db.session.commit()
+
+    return len(due)
+
+
+@app.route('/epayment/webhook', methods=['POST'])
+def stripe_webhook():
+    if not webhook_secret:
+        return jsonify(
+            {
+                "code": 503,
+                "message": "The Stripe webhook secret is not configured."
+            }
+        ), 503
+
     try:
-        session = stripe.checkout.Session.retrieve(session_id)
-        payment_status = session.payment_status
-    except stripe.error.InvalidRequestError:
-        return f"Invalid session ID: {session_id}"
-    except stripe.error.APIConnectionError:
-        return "Could not connect to Stripe's API"
-
-    if payment_status == 'paid':
-        payment = epayment.query.filter_by(session_id=session_id).first()
-        if payment:
-            try:
-                payment.status = 'paid'
-                db.session.commit()
-                return redirect("http://localhost:5173/queue-ticket")
-            except:
-                return jsonify(
-                    {
-                        "code": 500,
-                        "message": "An error occurred while updating the payment.",
-                        "data": payment
-                    }
-                ), 500
-    elif payment_status == 'unpaid':
-        await asyncio.sleep(30)
-        return await check_payment_status(session_id)
+        event = stripe.Webhook.construct_event(
+            request.get_data(), request.headers.get("Stripe-Signature", ""), webhook_secret)
+    except (ValueError, stripe.error.SignatureVerificationError):
+        return jsonify(
+            {
+                "code": 400,
+                "message": "Invalid webhook payload or signature."
+            }
+        ), 400
+
+    session = event["data"]["object"]
+    if event["type"] in ("checkout.session.completed", "checkout.session.async_payment_succeeded",
+                         "checkout.session.expired"):
+        outcome = session_outcome(session)
+    elif event["type"] == "checkout.session.async_payment_failed":
+        outcome = "failed"
     else:
-        return "Payment failed or refunded"
+        outcome = None
+
+    if outcome:
+        try:
+            settle_payment(session["id"], outcome)
+        except:
+            db.session.rollback()
+            return jsonify(
+                {
+                    "code": 500,
+                    "message": "An error occurred while updating the payment."
+                }
+            ), 500
+
+    return jsonify(
+        {
+            "code": 200,
+            "data": {
+                "received": event["type"]
+            }
+        }
+    ), 200
+
+
+@app.route('/epayment/check_payment_status/<session_id>', methods=['GET'])
+def check_payment_status(session_id):
+    payment = epayment.query.filter_by(session_id=session_id).first()
+    if not payment:
+        return jsonify(
+            {
+                "code": 404,
+                "data": {
+                    "session_id": session_id
+                },
+                "message": "Payment not found."
+            }
+        ), 404
+
+    if payment.status == 'paid':
+        return redirect("http://localhost:5173/queue-ticket")
+
+    if payment.status == 'unpaid':
+        # the customer has just come back from Stripe: check this session on the next pass instead of
+        # waiting out its backoff, in case the webhook is late
+        payment.next_check = datetime.now()
+        db.session.commit()
+        reconcile_wakeup.set()
+
+    return jsonify(
+        {
+            "code": 200,
+            "data": payment.json()
+        }
+    ), 200
 
 
 @app.get("/epayment")
 def get_all():
-    paymentList = epayment.query.all()
+    filters = {
+        "account_id": epayment.account_id, "status": epayment.status
+    }
+    if wants_stream():
+        return stream_rows(epayment.query, epayment.session_id, filters=filters)
+
+    paymentList, next_cursor = paginate(epayment.query, epayment.session_id, filters=filters)
     if len(paymentList):
         return jsonify(
             {
                 "code": 200,
                 "data": {
                     "payment": [payment.json() for payment in paymentList]
-                }
+                },
+                "next_cursor": next_cursor
             }
         )
     return jsonify(
@@ -136,4 +392,8 @@ def get_all():
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=6203, debug=True)
+    debug = True
+    # the debug reloader runs this module in a watcher process as well; only the serving process reconciles
+    if not debug or environ.get("WERKZEUG_RUN_MAIN") == "true":
+        threading.Thread(target=reconcile_payments, daemon=True).start()
+    app.run(host='0.0.0.0', port=6203, debug=debug)
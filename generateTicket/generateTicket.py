@@ -7,7 +7,6 @@ from os import environ
 from invokes import invoke_http
 import requests
 import json
-import pika
 import amqp_setup
 
 # app = Flask(__name__)
@@ -36,8 +35,7 @@ def ticketCallback(channel, method, properties, body):
     generate_queue_tickets(data)
 
 def generate_queue_tickets(data, message):
-    amqp_setup.channel.basic_publish(exchange=amqp_setup.exchangename, routing_key="notification.sms",
-                                    body=message, properties=pika.BasicProperties(delivery_mode=2))
+    amqp_setup.publish(amqp_setup.exchangename, "notification.sms", message)
 
     print("Queue Ticket successfully generated!", flush=True)
 
@@ -2,7 +2,9 @@ from flask import Flask, request, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from os import environ
-from invokes import invoke_http
+from invokes import invoke_http, propagate_deadline
+from listing import paginate, handle_listing_errors
+from migrations import verify_schema, create_tables
 
 
 app = Flask(__name__)
@@ -14,6 +16,8 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_recycle': 299}
 db = SQLAlchemy(app)
 
 CORS(app)
+propagate_deadline(app)
+handle_listing_errors(app)
 
 verification_URL = environ.get('verificationURL')
 
@@ -36,19 +40,27 @@ class Grouping(db.Model):
     def json(self):
         return {"grouping_id": self.grouping_id,"list_account":self.list_account, "no_of_pax": self.no_of_pax, "description": self.description, "status": self.status}
 
+# schema changes, in order; see common/migrations.py
+MIGRATIONS = [
+    create_tables(db),
+]
+
 with app.app_context():
-    db.create_all()  
+    verify_schema(db, MIGRATIONS)
 
 @app.route("/grouping")
 def get_all():
-    groupinglist = Grouping.query.all()
+    groupinglist, next_cursor = paginate(Grouping.query, Grouping.grouping_id, filters={
+        "status": Grouping.status
+    })
     if len(groupinglist):
         return jsonify(
             {
                 "code": 200,
                 "data": {
                     "groupings": [grouping.json() for grouping in groupinglist]
-                }
+                },
+                "next_cursor": next_cursor
             }
         )
     return jsonify(
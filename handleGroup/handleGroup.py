@@ -2,17 +2,18 @@ from flask import Flask, request, jsonify
 from flask_cors import CORS
 import os
 import sys
+import asyncio
 from os import environ
 
 import requests
-from invokes import invoke_http
+from invokes import invoke_http, ainvoke_http, invoke_many, propagate_deadline
 import amqp_setup
-import pika
-import json
+import messages
 
 app = Flask(__name__)
 app.config['JSON_SORT_KEYS'] = False
 CORS(app)
+propagate_deadline(app)
 
 verification_URL = environ.get('verificationURL')
 group_URL = "http://grouping:6103/grouping"
@@ -31,15 +32,14 @@ def create_group():
             # return jsonify(result), result["code"]
 
             # For User Scenario 3, Update Challenge Status
-            challenge_message = {
-                "mission_id": 1,
-                "code": result["code"]
-            }
-
-            challenge_message.update(result["data"])
-            message = json.dumps(challenge_message)
+            challenge_message = messages.ChallengeComplete(
+                mission_id=1,
+                code=result["code"],
+                account_ids=result["data"]["group_obj"]["list_account"] if result["code"] in range(200, 300) else []
+            )
+            message, properties = messages.encode(challenge_message)
 
-            amqp_setup.channel.basic_publish(exchange=amqp_setup.exchangename1, routing_key="challenge.challenge_complete", body=message, properties=pika.BasicProperties(delivery_mode=2))
+            amqp_setup.publish(amqp_setup.exchangename1, "challenge.challenge_complete", message, properties)
 
             return result
 
@@ -93,7 +93,8 @@ def broadcast():
 ## first get all broadcast listing (scenario 1B steps 5, 6)
 @app.route("/handleGroup/broadcast_listings")
 def getAllBroadcasts():
-    all = invoke_http(broadcast_URL, method='GET')
+    ## pass the paging parameters (?after=&limit=) through to broadcast
+    all = invoke_http(broadcast_URL, method='GET', params=request.args.to_dict())
 
     code = all["code"]
     if code not in range(200,300):
@@ -189,6 +190,17 @@ def join_group():
                             for acc in joining_acct_id:
                                 account_list.append(acc)
 
+                            ## look up every member and their icebreakers concurrently before anything is changed,
+                            ## so a failed lookup leaves both groups as they were
+                            member_details = getMemberDetails(account_list)
+                            if member_details["code"] not in range(200,300):
+                                return jsonify({
+                                    "code": 500,
+                                    "data": {"joinGroup_result": member_details,
+                                             "message": "Failed to join group as collection of member details failed."
+                                    }
+                            })
+
                             merged_group_details = {
                                 "grouping_id": broadcasted_id,
                                 "list_account": account_list,
@@ -208,19 +220,20 @@ def join_group():
 
                             else: 
                                 delete_broadcast_result = processDeleteBroadcast(broadcasted_id)
-                                for account in update_group_result["data"]["list_account"]:
-                                        account_details = invoke_http(verification_URL + "account/" + str(account), method='GET')
-                                        notification_message = {"type":"inform","number_pax":update_group_result["data"]["no_of_pax"],"first_name":account_details["data"]["first_name"], "phone_number":account_details["data"]["phone"]}
-                                        message = json.dumps(notification_message)
-                                        amqp_setup.channel.basic_publish(exchange=amqp_setup.exchangename, routing_key="notification.sms",
-                                                    body=message, properties=pika.BasicProperties(delivery_mode=2))
+                                ## notify the members in order
+                                for account, (account_details, icebreaker_details) in zip(account_list, member_details["data"]):
+                                        notification_message = messages.Inform(idempotency_key="inform:" + str(broadcasted_id) + ":" + str(account),number_pax=update_group_result["data"]["no_of_pax"],first_name=account_details["data"]["first_name"], phone_number=account_details["data"]["phone"])
+                                        message, properties = messages.encode(notification_message)
+                                        amqp_setup.publish(amqp_setup.exchangename, "notification.sms", message, properties)
                                         
-                                        icebreaker_details = invoke_http(icebreakers_URL, method="GET")
-                                        notification_message_2 = {"type":"icebreakers","icebreakers":icebreaker_details,"first_name":account_details["data"]["first_name"],"phone_number":account_details["data"]["phone"]}
-
-                                        icebreaker_message = json.dumps(notification_message_2)
-                                        amqp_setup.channel.basic_publish(exchange=amqp_setup.exchangename, routing_key="notification.sms",
-                                                    body=icebreaker_message, properties=pika.BasicProperties(delivery_mode=2))
+                                        ## a failed icebreakers draw only costs the member that SMS, the group is already merged
+                                        if not icebreaker_found(icebreaker_details):
+                                            print("Skipping icebreakers for account", account, ":", icebreaker_details, flush=True)
+                                            continue
+                                        notification_message_2 = messages.Icebreakers(idempotency_key="icebreakers:" + str(broadcasted_id) + ":" + str(account),icebreaker_id=icebreaker_details["id"],statements=icebreaker_details["statements"],first_name=account_details["data"]["first_name"],phone_number=account_details["data"]["phone"])
+
+                                        icebreaker_message, properties = messages.encode(notification_message_2)
+                                        amqp_setup.publish(amqp_setup.exchangename, "notification.sms", icebreaker_message, properties)
                                 code = delete_broadcast_result["code"]
                                 if code not in range (200,300):
                                     return jsonify({
@@ -373,6 +386,48 @@ def getGroupingDetails(grouping_id):
     else:
         return groupingDetails_result
 
+def icebreaker_found(icebreaker_details):
+    ## the icebreakers service answers with the bare row; a failed call comes back from invoke_http with a code
+    return isinstance(icebreaker_details, dict) and icebreaker_details.get("code", 200) in range(200,300) \
+        and "id" in icebreaker_details and "statements" in icebreaker_details
+
+def getMemberDetails(account_list):
+    ## one batch lookup at verification for all accounts, alongside the icebreakers for every member
+    async def fetch():
+        batch = {
+            "lookups": [{"kind": "account", "id": account} for account in account_list],
+            "fields": {"account": ["first_name", "phone"]}
+        }
+        return await asyncio.gather(
+            ainvoke_http(verification_URL + "batch", method='POST', json=batch),
+            ## icebreakers are drawn at random per call, so each member's call must not be coalesced
+            invoke_many([{"url": icebreakers_URL, "method": "GET", "coalesce": False} for account in account_list])
+        )
+    batch_result, icebreakers = asyncio.run(fetch())
+
+    code = batch_result["code"]
+    if code not in range(200,300):
+        return {
+            "code": 500,
+            "data": {"memberDetails_result": batch_result},
+            "message": "Failed to look up the group members."
+        }
+
+    accounts = batch_result["data"].get("account", {})
+    for account in account_list:
+        account_details = accounts.get(str(account), {"code": 404})
+        if account_details["code"] not in range(200,300):
+            return {
+                "code": 500,
+                "data": {"account_id": account, "memberDetails_result": account_details},
+                "message": "Failed to look up a group member."
+            }
+
+    return {
+        "code": 200,
+        "data": [(accounts[str(account)], icebreaker_details) for account, icebreaker_details in zip(account_list, icebreakers)]
+    }
+
 def processUpdateBroadcast(info):
     url = broadcast_URL + "/" + str(info["grouping_id"])
     updateBroadcast_result = invoke_http(url, method='PATCH', json=info)
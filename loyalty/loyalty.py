@@ -4,8 +4,14 @@ from flask_cors import CORS
 from os import environ
 
 from datetime import datetime
+from sqlalchemy import case, func
+from sqlalchemy.exc import IntegrityError
+import threading
+import time
 
-from invokes import invoke_http
+from invokes import invoke_http, propagate_deadline
+from listing import paginate, handle_listing_errors
+from migrations import verify_schema, create_tables, create_index, add_column, run_sql
 
 app = Flask(__name__)
 app.config['JSON_SORT_KEYS'] = False
@@ -16,9 +22,16 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_recycle': 299}
 db = SQLAlchemy(app)
 
 CORS(app)
+propagate_deadline(app)
+handle_listing_errors(app)
 
 verification_URL = environ.get('verificationURL') or "http://localhost:6001/verification/"
 
+# In ledger mode every earn and redeem is an inserted LoyaltyEntry; the Loyalty row is a snapshot of the
+# balances of the folded entries and a balance is the snapshot plus the entries not folded yet.
+ledger_mode = environ.get("LOYALTY_LEDGER_MODE", "0") == "1"
+compact_interval = int(environ.get("LOYALTY_COMPACT_INTERVAL", 60)) # seconds between folding entries into the snapshots
+
 
 class Loyalty(db.Model):
     __tablename__ = 'loyaltys'
@@ -27,6 +40,7 @@ class Loyalty(db.Model):
     available_points = db.Column(db.Integer, nullable=False, default=0)
     redeemed_points = db.Column(db.Integer, nullable=False, default=0)
     total_points = db.Column(db.Integer, nullable=False, default=0)
+    ledger_entry_id = db.Column(db.Integer, nullable=False, default=0, server_default="0") # highest entry folded so far
 
     def __init__(self, account_id, available_points, redeemed_points, total_points):
         self.account_id = account_id
@@ -38,8 +52,41 @@ class Loyalty(db.Model):
         return {"account_id": self.account_id, "available_points": self.available_points, "redeemed_points": self.redeemed_points, "total_points": self.total_points}
 
 
+class LoyaltyEntry(db.Model):
+    __tablename__ = 'loyalty_entries'
+    entry_id = db.Column(db.Integer, primary_key=True)
+    account_id = db.Column(db.Integer, nullable=False, index=True)
+    kind = db.Column(db.String(16), nullable=False) # earn or redeem
+    points = db.Column(db.Integer, nullable=False)
+    idempotency_key = db.Column(db.String(128), unique=True)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    folded = db.Column(db.Boolean, nullable=False, default=False, server_default="0") # counted in the snapshot
+
+    def __init__(self, account_id, kind, points, idempotency_key=None, folded=False):
+        self.account_id = account_id
+        self.kind = kind
+        self.points = points
+        self.idempotency_key = idempotency_key
+        self.folded = folded
+
+    def json(self):
+        return {"entry_id": self.entry_id, "account_id": self.account_id, "kind": self.kind, "points": self.points, "idempotency_key": self.idempotency_key, "created": self.created}
+
+
+# schema changes, in order; see common/migrations.py
+MIGRATIONS = [
+    create_tables(db),
+    # loyaltys tables created before the ledger have no snapshot position yet
+    add_column("loyaltys", "ledger_entry_id", "INTEGER NOT NULL DEFAULT 0"),
+    # folding is tracked per entry instead of by entry id; entries below the old position were folded already
+    add_column("loyalty_entries", "folded", "BOOLEAN NOT NULL DEFAULT 0"),
+    run_sql("UPDATE loyalty_entries SET folded = 1 WHERE entry_id <= "
+            "(SELECT ledger_entry_id FROM loyaltys WHERE loyaltys.account_id = loyalty_entries.account_id)"),
+    create_index("loyalty_entries", "loyalty_entries_unfolded", ["folded", "account_id"]),
+]
+
 with app.app_context():
-    db.create_all()
+    verify_schema(db, MIGRATIONS)
     existing_loyalty_1 = db.session.query(Loyalty).filter(Loyalty.account_id==1).first()
     if not existing_loyalty_1:
       new_loyalty_1 = Loyalty(account_id=1, available_points=1000, redeemed_points=0, total_points=1000)
@@ -57,17 +104,221 @@ with app.app_context():
       db.session.commit()
 
 
+############   Ledger    #############
+
+earned_points = func.coalesce(func.sum(case((LoyaltyEntry.kind == "earn", LoyaltyEntry.points), else_=0)), 0)
+redeemed_points = func.coalesce(func.sum(case((LoyaltyEntry.kind == "redeem", LoyaltyEntry.points), else_=0)), 0)
+
+
+def ledger_tails(account_ids=None):
+    # account_id -> (earned, redeemed) in the entries not yet folded into the account's snapshot
+    query = db.session.query(LoyaltyEntry.account_id, earned_points, redeemed_points).filter(
+        LoyaltyEntry.folded == False)
+    if account_ids is not None:
+        query = query.filter(LoyaltyEntry.account_id.in_(account_ids))
+    return {account_id: (int(earned), int(redeemed)) for account_id, earned, redeemed in query.group_by(LoyaltyEntry.account_id)}
+
+
+def balance_json(loyalty, tails):
+    if not ledger_mode:
+        return loyalty.json()
+    earned, redeemed = tails.get(loyalty.account_id, (0, 0))
+    return {"account_id": loyalty.account_id, "available_points": loyalty.available_points + earned - redeemed, "redeemed_points": loyalty.redeemed_points + redeemed, "total_points": loyalty.total_points + earned}
+
+
+def balances_json(loyaltylist):
+    tails = ledger_tails([loyalty.account_id for loyalty in loyaltylist]) if ledger_mode else {}
+    return [balance_json(loyalty, tails) for loyalty in loyaltylist]
+
+
+def entry_exists(idempotency_key):
+    return idempotency_key is not None and LoyaltyEntry.query.filter_by(idempotency_key=idempotency_key).first() is not None
+
+
+def ledger_earn(account_id, data):
+    loyalty = Loyalty.query.filter_by(account_id=account_id).first()
+    if not loyalty:
+        return jsonify(
+            {
+                "code": 404,
+                "data": {
+                    "account_id": account_id
+                },
+                "message": "Loyalty not found."
+            }
+        ), 404
+
+    # nothing is locked: earns only insert, so they never wait on each other
+    try:
+        db.session.add(LoyaltyEntry(loyalty.account_id, "earn", data["points"], data.get("idempotency_key")))
+        db.session.commit()
+    except IntegrityError:
+        # the idempotency key was used already: the earn is applied once
+        db.session.rollback()
+
+    return jsonify(
+        {
+            "code": 200,
+            "data": balances_json([loyalty])[0]
+        }
+    ), 200
+
+
+def ledger_earn_batch(points, idempotency_keys):
+    for attempt in range(2):
+        loyaltylist = Loyalty.query.filter(Loyalty.account_id.in_(list(points))).all()
+        applied = set(entry.idempotency_key for entry in LoyaltyEntry.query.filter(
+            LoyaltyEntry.idempotency_key.in_([key for key, _, _ in idempotency_keys])))
+        found = set(loyalty.account_id for loyalty in loyaltylist)
+
+        unkeyed = dict(points)
+        entries = []
+        for key, account_id, earned in idempotency_keys:
+            unkeyed[account_id] -= earned
+            if account_id in found and key not in applied:
+                entries.append(LoyaltyEntry(account_id, "earn", earned, key))
+                applied.add(key)
+        entries += [LoyaltyEntry(account_id, "earn", earned, None)
+                    for account_id, earned in unkeyed.items() if account_id in found and earned]
+
+        try:
+            db.session.add_all(entries)
+            db.session.commit()
+            break
+        except IntegrityError:
+            # a concurrent request applied one of the keys: drop the applied ones and try again
+            db.session.rollback()
+            if attempt:
+                raise
+
+    return jsonify(
+        {
+            "code": 200,
+            "data": {
+                "loyaltys": balances_json(loyaltylist),
+                "not_found": sorted(set(points) - found)
+            }
+        }
+    ), 200
+
+
+def ledger_redeem(account_id, data):
+    # the snapshot row is locked so two redemptions cannot both spend the same balance
+    loyalty = Loyalty.query.filter_by(account_id=account_id).with_for_update().first()
+    if not loyalty:
+        db.session.rollback()
+        return jsonify(
+            {
+                "code": 404,
+                "data": {
+                    "account_id": account_id
+                },
+                "message": "Loyalty not found."
+            }
+        ), 404
+
+    if entry_exists(data.get("idempotency_key")):
+        balance = balances_json([loyalty])[0]
+        db.session.rollback()
+        return jsonify(
+            {
+                "code": 200,
+                "data": balance
+            }
+        ), 200
+
+    balance = balances_json([loyalty])[0]
+    if data["points"] > balance["available_points"]:
+        db.session.rollback()
+        return jsonify(
+            {
+                "code": 400,
+                "data": {
+                    "account_id": loyalty.account_id,
+                    "available_points": balance["available_points"]
+                },
+                "message": "Insufficient available points to redeem."
+            }
+        ), 400
+
+    try:
+        db.session.add(LoyaltyEntry(loyalty.account_id, "redeem", data["points"], data.get("idempotency_key")))
+        balance = balances_json([loyalty])[0]
+        db.session.commit()
+    except:
+        db.session.rollback()
+        return jsonify(
+            {
+                "code": 500,
+                "data": {
+                    "account_id": account_id
+                },
+                "message": "An error occurred updating the loyalty."
+            }
+        ), 500
+
+    return jsonify(
+        {
+            "code": 200,
+            "data": balance
+        }
+    ), 200
+
+
+def compact_ledger():
+    # fold the entries into the snapshots so that reads only ever sum a short tail
+    while True:
+        time.sleep(compact_interval)
+        try:
+            with app.app_context():
+                compacted = compact_ledger_once()
+            if compacted:
+                print("Compacted the loyalty ledger of", compacted, "accounts", flush=True)
+        except Exception as e:
+            print("Loyalty ledger compaction failed:", e, flush=True)
+
+
+def compact_ledger_once():
+    # Entries are folded by id, exactly the ones read in the transaction that folds them, and marked in that
+    # same transaction. An entry whose transaction commits later, whatever its id, is simply still unfolded
+    # and is picked up by the next run; nothing depends on ids being committed in order.
+    pending = [account_id for account_id, in db.session.query(LoyaltyEntry.account_id).filter(
+        LoyaltyEntry.folded == False).distinct()]
+    db.session.rollback()
+
+    for account_id in pending:
+        loyalty = Loyalty.query.filter_by(account_id=account_id).with_for_update().first()
+        if not loyalty:
+            db.session.rollback()
+            continue
+        entries = db.session.query(LoyaltyEntry.entry_id, LoyaltyEntry.kind, LoyaltyEntry.points).filter(
+            LoyaltyEntry.account_id == account_id, LoyaltyEntry.folded == False).all()
+        entry_ids = [entry_id for entry_id, _, _ in entries]
+        earned = sum(points for _, kind, points in entries if kind == "earn")
+        redeemed = sum(points for _, kind, points in entries if kind == "redeem")
+
+        LoyaltyEntry.query.filter(LoyaltyEntry.entry_id.in_(entry_ids)).update(
+            {LoyaltyEntry.folded: True}, synchronize_session=False)
+        loyalty.total_points += earned
+        loyalty.redeemed_points += redeemed
+        loyalty.available_points += earned - redeemed
+        loyalty.ledger_entry_id = max([loyalty.ledger_entry_id] + entry_ids)
+        db.session.commit()
+
+    return len(pending)
+
 
 @app.route("/loyalty")
 def get_all():
-    loyaltylist = Loyalty.query.all()
+    loyaltylist, next_cursor = paginate(Loyalty.query, Loyalty.account_id)
     if len(loyaltylist):
         return jsonify(
             {
                 "code": 200,
                 "data": {
-                    "loyalties": [loyalty.json() for loyalty in loyaltylist]
-                }
+                    "loyalties": balances_json(loyaltylist)
+                },
+                "next_cursor": next_cursor
             }
         ), 200
     return jsonify(
@@ -85,7 +336,7 @@ def find_loyalty_by_account_id(account_id):
         return jsonify(
             {
                 "code": 200,
-                "data": loyalty.json()
+                "data": balances_json([loyalty])[0]
             }
         ), 200
     return jsonify(
@@ -116,7 +367,7 @@ def create_loyalty():
         ), 400
 
     account_result = invoke_http(
-        verification_URL + "account/" + str(loyalty.account_id), method='GET')
+        verification_URL + "account/" + str(loyalty.account_id), method='GET', coalesce=True)
 
     if account_result["code"] in range(500, 600):
         return jsonify(
@@ -156,28 +407,49 @@ def create_loyalty():
     ), 201
 
 
+def invalid_points(points):
+    return not isinstance(points, int) or isinstance(points, bool) or points <= 0
+
+
 @app.route("/loyalty/<account_id>/earn", methods=['PATCH'])
 def update_loyalty_earn(account_id):
-    if (not Loyalty.query.filter_by(account_id=account_id).first()):
+    data = request.get_json()
+
+    if invalid_points(data.get("points")):
         return jsonify(
             {
-                "code": 404,
+                "code": 400,
                 "data": {
                     "account_id": account_id
                 },
-                "message": "Loyalty not found."
+                "message": "Points must be a positive whole number."
             }
-        ), 404
+        ), 400
 
-    loyalty = Loyalty.query.filter_by(account_id=account_id).first()
-    data = request.get_json()
+    if ledger_mode:
+        return ledger_earn(account_id, data)
 
+    # one conditional UPDATE instead of read-modify-write, so concurrent earns cannot overwrite each other
     try:
-        loyalty.total_points += data['points']
-        loyalty.available_points += data['points']
+        updated = Loyalty.query.filter_by(account_id=account_id).update({
+            Loyalty.total_points: Loyalty.total_points + data['points'],
+            Loyalty.available_points: Loyalty.available_points + data['points']
+        }, synchronize_session=False)
+        if updated and data.get("idempotency_key"):
+            # the key is recorded in the same transaction as the UPDATE, as an entry already counted in the snapshot
+            db.session.add(LoyaltyEntry(int(account_id), "earn", data['points'], data["idempotency_key"], folded=True))
+            db.session.flush()
+        loyalty = Loyalty.query.filter_by(account_id=account_id).first()
         db.session.commit()
 
+    except IntegrityError:
+        # the idempotency key was used already: the earn is applied once
+        db.session.rollback()
+        loyalty = Loyalty.query.filter_by(account_id=account_id).first()
+        updated = 1
+
     except:
+        db.session.rollback()
         return jsonify(
             {
                 "code": 500,
@@ -188,6 +460,17 @@ def update_loyalty_earn(account_id):
             }
         ), 500
 
+    if not updated:
+        return jsonify(
+            {
+                "code": 404,
+                "data": {
+                    "account_id": account_id
+                },
+                "message": "Loyalty not found."
+            }
+        ), 404
+
     return jsonify(
         {
             "code": 200,
@@ -196,40 +479,155 @@ def update_loyalty_earn(account_id):
     ), 200
 
 
-@app.route("/loyalty/<account_id>/redeem", methods=['PATCH'])
-def update_loyalty_redeem(account_id):
-    if (not Loyalty.query.filter_by(account_id=account_id).first()):
+def invalid_earn(earn):
+    if not isinstance(earn, dict) or invalid_points(earn.get("points")):
+        return "Points must be a positive whole number."
+    if not str(earn.get("account_id", "")).isdigit():
+        return "Account id must be a whole number."
+    if earn.get("idempotency_key") is not None and not isinstance(earn["idempotency_key"], str):
+        return "Idempotency key must be a string."
+    return None
+
+
+@app.route("/loyalty/batch/earn", methods=['PATCH'])
+def update_loyalty_earn_batch():
+    # Credit many accounts in one statement, e.g. {"earns": [{"account_id": 1, "points": 100}, ...]}
+    data = request.get_json(silent=True)
+    earns = data.get("earns") if isinstance(data, dict) else data
+    if not isinstance(earns, list):
         return jsonify(
             {
-                "code": 404,
+                "code": 400,
+                "message": "Expected a list of earns."
+            }
+        ), 400
+
+    points = {}
+    idempotency_keys = [] # (key, account_id, points) of the earns that carry a key
+    for earn in earns:
+        message = invalid_earn(earn)
+        if message:
+            return jsonify(
+                {
+                    "code": 400,
+                    "data": {
+                        "earn": earn
+                    },
+                    "message": message
+                }
+            ), 400
+        account_id = int(earn["account_id"])
+        points[account_id] = points.get(account_id, 0) + earn["points"]
+        if earn.get("idempotency_key"):
+            idempotency_keys.append((earn["idempotency_key"], account_id, earn["points"]))
+
+    if not points:
+        return jsonify(
+            {
+                "code": 200,
                 "data": {
-                    "account_id": account_id
+                    "loyaltys": [],
+                    "not_found": []
+                }
+            }
+        ), 200
+
+    if ledger_mode:
+        return ledger_earn_batch(points, idempotency_keys)
+
+    for attempt in range(2):
+        found = set(account_id for account_id, in db.session.query(Loyalty.account_id).filter(
+            Loyalty.account_id.in_(list(points))))
+        applied = set(entry.idempotency_key for entry in LoyaltyEntry.query.filter(
+            LoyaltyEntry.idempotency_key.in_([key for key, _, _ in idempotency_keys])))
+
+        # earns whose key was applied before are left out; the new keys are recorded with the UPDATE
+        pending = dict(points)
+        entries = []
+        for key, account_id, earned in idempotency_keys:
+            if key in applied:
+                pending[account_id] -= earned
+            elif account_id in found:
+                entries.append(LoyaltyEntry(account_id, "earn", earned, key, folded=True))
+                applied.add(key)
+        pending = {account_id: earned for account_id, earned in pending.items() if earned}
+
+        # UPDATE loyaltys SET total_points = total_points + CASE account_id WHEN ... END ... WHERE account_id IN (...)
+        try:
+            if pending:
+                earned = case(pending, value=Loyalty.account_id, else_=0)
+                Loyalty.query.filter(Loyalty.account_id.in_(list(pending))).update({
+                    Loyalty.total_points: Loyalty.total_points + earned,
+                    Loyalty.available_points: Loyalty.available_points + earned
+                }, synchronize_session=False)
+            db.session.add_all(entries)
+            db.session.flush()
+            loyaltylist = Loyalty.query.filter(Loyalty.account_id.in_(list(points))).all()
+            db.session.commit()
+            break
+
+        except IntegrityError:
+            # a concurrent request applied one of the keys: drop the applied ones and try again
+            db.session.rollback()
+            if not attempt:
+                continue
+
+        except:
+            db.session.rollback()
+
+        return jsonify(
+            {
+                "code": 500,
+                "data": {
+                    "account_ids": list(points)
                 },
-                "message": "Loyalty not found."
+                "message": "An error occurred updating the loyalty."
             }
-        ), 404
+        ), 500
 
-    loyalty = Loyalty.query.filter_by(account_id=account_id).first()
+    not_found = sorted(set(points) - set(loyalty.account_id for loyalty in loyaltylist))
+
+    return jsonify(
+        {
+            "code": 200,
+            "data": {
+                "loyaltys": [loyalty.json() for loyalty in loyaltylist],
+                "not_found": not_found
+            }
+        }
+    ), 200
+
+
+@app.route("/loyalty/<account_id>/redeem", methods=['PATCH'])
+def update_loyalty_redeem(account_id):
     data = request.get_json()
 
-    if data["points"] > loyalty.available_points:
+    if invalid_points(data.get("points")):
         return jsonify(
             {
                 "code": 400,
                 "data": {
-                    "account_id": loyalty.account_id,
-                    "available_points": loyalty.available_points
+                    "account_id": account_id
                 },
-                "message": "Insufficient available points to redeem."
+                "message": "Points must be a positive whole number."
             }
         ), 400
 
+    if ledger_mode:
+        return ledger_redeem(account_id, data)
+
+    # the balance check is part of the UPDATE, so two redemptions can never spend the same points
     try:
-        loyalty.redeemed_points += data['points']
-        loyalty.available_points -= data['points']
+        updated = Loyalty.query.filter(
+            Loyalty.account_id == account_id, Loyalty.available_points >= data['points']).update({
+                Loyalty.redeemed_points: Loyalty.redeemed_points + data['points'],
+                Loyalty.available_points: Loyalty.available_points - data['points']
+            }, synchronize_session=False)
+        loyalty = Loyalty.query.filter_by(account_id=account_id).first()
         db.session.commit()
 
     except:
+        db.session.rollback()
         return jsonify(
             {
                 "code": 500,
@@ -240,6 +638,29 @@ def update_loyalty_redeem(account_id):
             }
         ), 500
 
+    if not loyalty:
+        return jsonify(
+            {
+                "code": 404,
+                "data": {
+                    "account_id": account_id
+                },
+                "message": "Loyalty not found."
+            }
+        ), 404
+
+    if not updated:
+        return jsonify(
+            {
+                "code": 400,
+                "data": {
+                    "account_id": loyalty.account_id,
+                    "available_points": loyalty.available_points
+                },
+                "message": "Insufficient available points to redeem."
+            }
+        ), 400
+
     return jsonify(
         {
             "code": 200,
@@ -247,6 +668,9 @@ def update_loyalty_redeem(account_id):
         }
     ), 200
 
-
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=6301, debug=True)
+    debug = True
+    # the debug reloader runs this module in a watcher process as well; only the serving process compacts
+    if ledger_mode and (not debug or environ.get("WERKZEUG_RUN_MAIN") == "true"):
+        threading.Thread(target=compact_ledger, daemon=True).start()
+    app.run(host='0.0.0.0', port=6301, debug=debug)
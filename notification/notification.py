@@ -1,75 +1,457 @@
-import json
+import hashlib
 import pika
+import sqlite3
 import amqp_setup
+import messages
+import functools
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from os import environ
 
-from notificationapi_python_server_sdk import (notificationapi)
+import requests
+from requests.adapters import HTTPAdapter
 
 monitorBindingKey = '#'
 
+prefetch_count = int(environ.get("NOTIFICATION_PREFETCH", 20)) # unacked messages the broker may hand us at once
+worker_count = int(environ.get("NOTIFICATION_WORKERS", 8)) # notifications sent in parallel
+stats_interval = int(environ.get("NOTIFICATION_STATS_INTERVAL", 30)) # seconds between queue lag / in-flight reports
+bulk_window_ms = float(environ.get("NOTIFICATION_BULK_WINDOW_MS", 0)) # how long sends are gathered before going out together; 0 = send at once
+rate_limit = float(environ.get("NOTIFICATION_RATE_LIMIT", 0)) # sends per second allowed per provider account; 0 = unlimited
+rate_burst = int(environ.get("NOTIFICATION_RATE_BURST", 10)) # sends allowed back to back before the rate limit applies
+provider_timeout = float(environ.get("NOTIFICATION_PROVIDER_TIMEOUT", 10)) # seconds
+coalesce_window = float(environ.get("NOTIFICATION_COALESCE_WINDOW", 0)) # seconds SMS to one phone are held to merge into a digest; 0 = off
+coalesce_max_held = int(environ.get("NOTIFICATION_COALESCE_MAX_HELD", 200)) # SMS held at once; past this they are sent straight away
+# Digests go out as this NotificationAPI notification, which must exist in every provider account used for SMS
+# with an SMS template rendering {{count}} and the {{notifications}} list. The list mixes kinds (e.g. the
+# inform_full_group and icebreakers pair join_group sends each member): every item holds the merged message's
+# own merge tags plus its notificationId, for the template to pick the wording of each kind. Coalescing stays
+# off until it is set.
+digest_notification_id = environ.get("NOTIFICATION_DIGEST_ID", "")
+dedupe_backend = environ.get("NOTIFICATION_DEDUPE_BACKEND", "memory") # memory or sqlite
+dedupe_path = environ.get("NOTIFICATION_DEDUPE_PATH", "notification_dedupe.db") # sqlite file, kept across restarts
+dedupe_window = int(environ.get("NOTIFICATION_DEDUPE_WINDOW", 86400)) # seconds a sent key suppresses repeats
+dedupe_max_keys = int(environ.get("NOTIFICATION_DEDUPE_MAX_KEYS", 100000)) # least recently seen keys are evicted past this
+
+email_queue_name = 'Email'
+sms_queue_name = 'SMS'
+
+# Messages are handed to a bounded pool of senders and acked only once the provider accepted them;
+# prefetch keeps at most prefetch_count messages unacked, so a crash loses nothing.
+executor = ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix="notification")
+in_flight = 0
+in_flight_lock = threading.Lock()
+
+# idempotency key -> Future of the send in progress, resolved with whether the provider accepted it
+sending = {}
+sending_lock = threading.Lock()
+
+
 
 def receiveNotificationLog():
     amqp_setup.check_setup()
 
-    email_queue_name = 'Email'
-    sms_queue_name = 'SMS'
+    channel = amqp_setup.channel
+    # held SMS stay unacked for the coalescing window: give them slots of their own on top of the senders'
+    channel.basic_qos(prefetch_count=prefetch_count + (coalesce_max_held if coalesce_window > 0 else 0))
 
     # set up a consumer and start to wait for coming messages
-    amqp_setup.channel.basic_consume(
-        queue=email_queue_name, on_message_callback=email_callback, auto_ack=True)
-    amqp_setup.channel.basic_consume(
-        queue=sms_queue_name, on_message_callback=sms_callback, auto_ack=True)
+    channel.basic_consume(
+        queue=email_queue_name, on_message_callback=functools.partial(dispatch, messages.Email.type), auto_ack=False)
+    channel.basic_consume(
+        queue=sms_queue_name, on_message_callback=functools.partial(dispatch, None), auto_ack=False)
+    amqp_setup.connection.call_later(stats_interval, functools.partial(report_stats, channel))
     # an implicit loop waiting to receive messages;
-    amqp_setup.channel.start_consuming()
+    channel.start_consuming()
     # it doesn't exit by default. Use Ctrl+C in the command window to terminate it.
 
 
-# required signature for the callback; no return
-def email_callback(channel, method, properties, body):
-    print("This is notification.py...", flush=True)
-    print("Received email message:", json.loads(body), flush=True)
-
-    data = json.loads(body)
+def dispatch(default_type, channel, method, properties, body):
+    # runs on the consuming thread: hand the message to a sender and return to consuming straight away
+    global in_flight
+    with in_flight_lock:
+        in_flight += 1
+    executor.submit(send, default_type, channel, method, properties, body)
+
+
+def send(default_type, channel, method, properties, body):
+    # runs on a sender thread; the ack/nack is handed back to the consuming thread, which owns the channel.
+    # Nothing raised here reaches anyone (the executor keeps it), so every path must end in finish.
+    try:
+        deliver(default_type, channel, method, properties, body)
+    except Exception as e:
+        print("Failed to handle notification:", e, flush=True)
+        finish(channel, method, body, False)
+
+
+def deliver(default_type, channel, method, properties, body):
+    try:
+        message = messages.decode(body, properties, default_type)
+    except messages.MessageError as e:
+        print("Failed to read notification:", e, flush=True)
+        finish(channel, method, body, False)
+        return
+
+    print("Received message:", message, flush=True)
+
+    key = idempotency_key(message, body)
+    with sending_lock:
+        first = sending.get(key)
+        if first is None:
+            if dedupe_store.seen(key):
+                # sent within the window: a redelivery or replay, ack it without sending
+                print("Skipping duplicate notification", key, flush=True)
+                finish(channel, method, body, True)
+                return
+            sending[key] = Future()
+
+    if first is not None:
+        # the same notification is being sent right now: this copy settles with that send's outcome
+        print("Holding duplicate notification", key, flush=True)
+        first.add_done_callback(lambda outcome: finish(channel, method, body, outcome.result()))
+        return
+
+    try:
+        outcome = handlers[message.type](message)
+    except Exception as e:
+        print("Failed to send notification:", e, flush=True)
+        sent(channel, method, body, key, False)
+        return
+
+    if isinstance(outcome, Future):
+        # the send was queued for a bulk flush or a digest; settle once the provider answered
+        outcome.add_done_callback(lambda outcome: sent(channel, method, body, key, outcome.exception() is None))
+    else:
+        sent(channel, method, body, key, True)
+
+
+def sent(channel, method, body, key, accepted):
+    # the key is recorded only once the provider took the send, so a crash before that (or while the
+    # message was held) ends in a redelivery that is sent, not skipped
+    try:
+        if accepted:
+            dedupe_store.record(key)
+    finally:
+        with sending_lock:
+            first = sending.pop(key)
+        first.set_result(accepted)
+        finish(channel, method, body, accepted)
+
+
+def finish(channel, method, body, accepted):
+    global in_flight
+    with in_flight_lock:
+        in_flight -= 1
+
+    amqp_setup.connection.add_callback_threadsafe(
+        functools.partial(settle, channel, method, body, accepted))
+
+
+def settle(channel, method, body, accepted):
+    if accepted:
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+    elif not method.redelivered:
+        # give the message one more try
+        channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+    else:
+        # failed twice: park it on the Error queue instead of retrying forever
+        channel.basic_publish(exchange=amqp_setup.exchangename, routing_key="notification.error",
+                              body=body, properties=pika.BasicProperties(delivery_mode=2))
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+
+
+def report_stats(channel):
+    # queue lag is what is still waiting in the broker; in flight is what the senders are working on
+    lag = {}
+    for queue_name in [email_queue_name, sms_queue_name]:
+        lag[queue_name] = channel.queue_declare(queue=queue_name, durable=True, passive=True).method.message_count
+    print("Notification stats: queue lag", lag, "in flight", in_flight, flush=True)
+
+    amqp_setup.connection.call_later(stats_interval, functools.partial(report_stats, channel))
+
+
+############   Dedupe    #############
+
+def idempotency_key(message, body):
+    # producers set a key naming the event; anything without one is keyed by its exact payload
+    if message.idempotency_key:
+        return str(message.idempotency_key)
+    if isinstance(body, str):
+        body = body.encode()
+    return "sha256:" + hashlib.sha256(body).hexdigest()
+
+
+class MemoryDedupeStore:
+    """Keys of the notifications sent within the last window seconds, at most max_keys of them,
+       least recently seen evicted first.
+    """
+    def __init__(self, window, max_keys):
+        self.window = window
+        self.max_keys = max_keys
+        self.keys = OrderedDict() # key -> time sent, least recently seen first
+        self.lock = threading.Lock()
+
+    def seen(self, key):
+        # True if the key was sent within the window
+        with self.lock:
+            sent = self.keys.get(key)
+            if sent is None or time.time() - sent >= self.window:
+                return False
+            self.keys.move_to_end(key)
+            return True
+
+    def record(self, key):
+        with self.lock:
+            self.keys[key] = time.time()
+            self.keys.move_to_end(key)
+            while len(self.keys) > self.max_keys:
+                self.keys.popitem(last=False)
+
+
+class SQLiteDedupeStore:
+    """Same as MemoryDedupeStore, kept in a SQLite file so a restarted worker still knows what it sent.
+       Old keys are evicted in one sweep whenever the table grows past max_keys, down to 90% of it,
+       so a send costs an insert and only one in every tenth of max_keys sends pays for a sweep.
+    """
+    def __init__(self, path, window, max_keys):
+        self.window = window
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("CREATE TABLE IF NOT EXISTS sent_keys (key TEXT PRIMARY KEY, sent REAL NOT NULL, seen REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS sent_keys_seen ON sent_keys (seen)")
+        self.rows = self.db.execute("SELECT COUNT(*) FROM sent_keys").fetchone()[0]
+
+    def seen(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT sent FROM sent_keys WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[0] >= self.window:
+                return False
+            self.db.execute("UPDATE sent_keys SET seen = ? WHERE key = ?", (now, key))
+            return True
+
+    def record(self, key):
+        now = time.time()
+        with self.lock:
+            if self.db.execute("INSERT OR IGNORE INTO sent_keys (key, sent, seen) VALUES (?, ?, ?)", (key, now, now)).rowcount:
+                self.rows += 1
+            else:
+                self.db.execute("UPDATE sent_keys SET sent = ?, seen = ? WHERE key = ?", (now, now, key))
+            if self.rows > self.max_keys:
+                self.evict(now)
+
+    def evict(self, now):
+        self.db.execute("DELETE FROM sent_keys WHERE sent < ?", (now - self.window,))
+        self.db.execute("DELETE FROM sent_keys WHERE key IN (SELECT key FROM sent_keys ORDER BY seen DESC LIMIT -1 OFFSET ?)",
+                        (int(self.max_keys * 0.9),))
+        self.rows = self.db.execute("SELECT COUNT(*) FROM sent_keys").fetchone()[0]
+
+
+if dedupe_backend == "sqlite":
+    dedupe_store = SQLiteDedupeStore(dedupe_path, dedupe_window, dedupe_max_keys)
+else:
+    dedupe_store = MemoryDedupeStore(dedupe_window, dedupe_max_keys)
+
+
+############   Provider    #############
+
+class ProviderError(Exception):
+    pass
+
+
+class TokenBucket:
+    """Rate limiter: allows rate sends per second on average, and bursts of up to capacity.
+       Any object with an acquire() method can be given to ProviderClient instead.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class ProviderClient:
+    """NotificationAPI sender for one account, created once and reused by every sender thread.
+       Keeps its own keep-alive connections, so sends for different accounts never share state.
+    """
+    def __init__(self, client_id, client_secret, rate_limiter=None):
+        self.url = "https://api.notificationapi.com/" + client_id + "/sender"
+        self.rate_limiter = rate_limiter
+
+        self.session = requests.Session()
+        self.session.auth = (client_id, client_secret)
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=worker_count))
+
+    def send(self, params):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+        r = self.session.post(self.url, json=params, timeout=provider_timeout)
+        if r.status_code not in range(200, 300):
+            raise ProviderError("NotificationAPI rejected the request (" + str(r.status_code) + "): " + r.text)
+
+
+def new_provider_client(client_id, client_secret):
+    rate_limiter = TokenBucket(rate_limit, rate_burst) if rate_limit > 0 else None
+    return ProviderClient(client_id, client_secret, rate_limiter)
+
+
+class BulkSender:
+    """Gathers sends for bulk_window_ms and then releases them together. NotificationAPI has no bulk
+       endpoint, so every send of a window is still its own request: they are spread over worker_count
+       threads, never sent one after another. Each send gets a future resolved with its own outcome.
+    """
+    def __init__(self, window_ms):
+        self.window = window_ms / 1000
+        self.pending = [] # (client, params, future)
+        self.lock = threading.Lock()
+        self.flush_scheduled = False
+        self.flush_executor = ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix="bulk_send")
+
+    def submit(self, client, params):
+        future = Future()
+        if self.window <= 0:
+            try:
+                client.send(params)
+                future.set_result(True)
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        with self.lock:
+            self.pending.append((client, params, future))
+            schedule = not self.flush_scheduled
+            self.flush_scheduled = True
+        if schedule:
+            threading.Timer(self.window, self.flush).start()
+        return future
+
+    def flush(self):
+        with self.lock:
+            held = self.pending
+            self.pending = []
+            self.flush_scheduled = False
+
+        for client, params, future in held:
+            self.flush_executor.submit(self.send_one, client, params, future)
+
+    @staticmethod
+    def send_one(client, params, future):
+        try:
+            client.send(params)
+            future.set_result(True)
+        except Exception as e:
+            future.set_exception(e)
+
+
+class SmsCoalescer:
+    """Holds SMS per provider account and phone number for window seconds; if more than one arrived,
+       they go out as one digest SMS. Every held message settles with the digest's outcome.
+    """
+    def __init__(self, window, max_held):
+        self.window = window
+        self.max_held = max_held
+        self.held_count = 0
+        self.pending = {} # (client, phone_number) -> [(params, future)]
+        self.lock = threading.Lock()
+
+    def submit(self, client, params):
+        future = Future()
+        key = (client, params["user"]["number"])
+        with self.lock:
+            if self.held_count >= self.max_held:
+                # the prefetch slots set aside for held SMS are all taken
+                return bulk_sender.submit(client, params)
+            self.held_count += 1
+            held = self.pending.setdefault(key, [])
+            held.append((params, future))
+            first = len(held) == 1
+        if first:
+            threading.Timer(self.window, self.flush, args=(key,)).start()
+        return future
+
+    def flush(self, key):
+        with self.lock:
+            held = self.pending.pop(key)
+            self.held_count -= len(held)
+
+        client = key[0]
+        if len(held) == 1:
+            params = held[0][0]
+        else:
+            params = digest([params for params, _ in held])
+        outcome = bulk_sender.submit(client, params)
+        outcome.add_done_callback(functools.partial(settle_held, [future for _, future in held]))
+
+
+def digest(batch):
+    # the digest template lists every merged notification with its own merge tags
+    tags = batch[0]["mergeTags"]
+    return {
+        "notificationId": digest_notification_id,
+        "templateId": "default",
+        "user": batch[0]["user"],
+        "mergeTags": {
+            "firstName": tags.get("firstName", tags.get("first_name")),
+            "count": len(batch),
+            "notifications": [dict(params["mergeTags"], notificationId=params["notificationId"]) for params in batch]
+        }
+    }
 
-    send_notification_email(data["first_name"], data["email"])
 
+def settle_held(futures, outcome):
+    for future in futures:
+        if outcome.exception() is None:
+            future.set_result(True)
+        else:
+            future.set_exception(outcome.exception())
 
-def sms_callback(channel, method, properties, body):
-    print("This is notification.py...", flush=True)
-    print("Received sms message:", json.loads(body), flush=True)
 
-    data = json.loads(body)
+def submit_sms(client, params):
+    if coalesce_window > 0:
+        return sms_coalescer.submit(client, params)
+    return bulk_sender.submit(client, params)
 
-    if data["type"] == "completion":
-      send_notification_challenge_complete_sms(data["mission_name"],
-          data["first_name"], data["phone_number"], data["award_points"])
 
-    if data["type"] == "redeem":
-      send_notification_redemption_redeem_sms(data["reward_name"],
-          data["first_name"], data["phone_number"], data["redemption_code"])
-      
-    if data["type"] == "inform":
-        send_notification_handleGroup_sms(data["number_pax"],data["first_name"],data["phone_number"])
-    
-    if data["type"] == "queueticket":
-        send_notification_queueTicket_sms(data["account_id"],data["queue_id"],data["payment_method"],data["phone_number"],data["first_name"])
+# one client per NotificationAPI account, initialised once for the whole worker
+challenge_client = new_provider_client("4520cecngqlnq5guo9dbe26dte",
+                                       "1d1pfufn15hbv31ibs36458t92319pis5lllihcho22b94jai0na")
+group_client = new_provider_client("f130gmogsmq75oiffj86pj22o",
+                                   "1m9bajhvi84ssqo49hd97srlg6huer14f2ii7mp1l986tjc74rgv")
+queue_client = new_provider_client("4tjgaihoti8buperss4ou9kpcp",
+                                   "g3nlqqqbj081o7aqvoln06fljcheg23rag0pe1j7s6kmggo7ffu")
 
-    if data["type"] == "use_queue":
-        send_notification_use_queue_sms(data["account_id"],data["queue_id"],data["payment_method"],data["phone_number"],data["first_name"])
+bulk_sender = BulkSender(bulk_window_ms)
+if coalesce_window > 0 and not digest_notification_id:
+    print("NOTIFICATION_COALESCE_WINDOW is set but NOTIFICATION_DIGEST_ID is not: SMS coalescing is off", flush=True)
+    coalesce_window = 0
+sms_coalescer = SmsCoalescer(coalesce_window, coalesce_max_held)
 
-    if data["type"] == "promo":
-        send_notification_promo_sms(data["account_id"],data["promo_code"],data["first_name"],data["phone_number"])
-    
-    if data["type"] == "icebreakers":
-        send_notification_icebreakers_sms(data["icebreakers"]["id"],data["icebreakers"]["statements"],data["first_name"],data["phone_number"])
 
+def report_sent(future, message):
+    future.add_done_callback(lambda f: print(message, flush=True) if f.exception() is None else None)
+    return future
 
 
 def send_notification_email(first_name, email):
-    # init
-    notificationapi.init("4520cecngqlnq5guo9dbe26dte",
-                         "1d1pfufn15hbv31ibs36458t92319pis5lllihcho22b94jai0na")
     # send email
-    notificationapi.send({
+    future = bulk_sender.submit(challenge_client, {
         "notificationId": "email",
         "templateId": "default",
         "user": {
@@ -79,15 +461,12 @@ def send_notification_email(first_name, email):
         "mergeTags": {"firstName": first_name}
     })
 
-    print("Email successfully sent!", flush=True)
+    return report_sent(future, "Email successfully sent!")
 
 
 def send_notification_challenge_complete_sms(mission_name, first_name, phone_number, award_points):
-    # init
-    notificationapi.init("4520cecngqlnq5guo9dbe26dte",
-                         "1d1pfufn15hbv31ibs36458t92319pis5lllihcho22b94jai0na")
     # send sms
-    notificationapi.send({
+    future = submit_sms(challenge_client, {
         "notificationId": "sms",
         "templateId": "default",
         "user": {
@@ -97,15 +476,12 @@ def send_notification_challenge_complete_sms(mission_name, first_name, phone_num
         "mergeTags": {"firstName": first_name, "missionName": mission_name, "awardPoints": award_points}
     })
 
-    print("Challenge Completion SMS successfully sent!", flush=True)
+    return report_sent(future, "Challenge Completion SMS successfully sent!")
 
 
 def send_notification_redemption_redeem_sms(reward_name, first_name, phone_number, redemption_code):
-    # init
-    notificationapi.init("4520cecngqlnq5guo9dbe26dte",
-                         "1d1pfufn15hbv31ibs36458t92319pis5lllihcho22b94jai0na")
     # send sms
-    notificationapi.send({
+    future = submit_sms(challenge_client, {
         "notificationId": "sms",
         "templateId": "6d251e1d-2e4e-45fc-b5d6-dc5f4630fd8a",
         "user": {
@@ -115,13 +491,11 @@ def send_notification_redemption_redeem_sms(reward_name, first_name, phone_numbe
         "mergeTags": {"firstName": first_name, "rewardName": reward_name, "redemptionCode": redemption_code}
     })
 
-    print("Challenge Completion SMS successfully sent!", flush=True)
+    return report_sent(future, "Challenge Completion SMS successfully sent!")
 
 def send_notification_handleGroup_sms(number_pax, first_name,phone_number):
-    notificationapi.init("f130gmogsmq75oiffj86pj22o",
-                         "1m9bajhvi84ssqo49hd97srlg6huer14f2ii7mp1l986tjc74rgv")
     # send sms
-    notificationapi.send({
+    future = submit_sms(group_client, {
         "notificationId": "inform_full_group",
         "templateId": "default",
         "user": {
@@ -130,13 +504,11 @@ def send_notification_handleGroup_sms(number_pax, first_name,phone_number):
         },
         "mergeTags": {"firstName": first_name, "numberPax": number_pax}
     })
-    print("Notification SMS about full group successfully sent!", flush=True)
+    return report_sent(future, "Notification SMS about full group successfully sent!")
 
 def send_notification_queueTicket_sms(account_id, queue_id, payment_method, phone_number, first_name):
-    notificationapi.init("4tjgaihoti8buperss4ou9kpcp", 
-                        "g3nlqqqbj081o7aqvoln06fljcheg23rag0pe1j7s6kmggo7ffu")
     # send sms
-    notificationapi.send({
+    future = submit_sms(queue_client, {
         "notificationId": "queueticket",
         "templateId": "default",
         "user": {
@@ -145,13 +517,11 @@ def send_notification_queueTicket_sms(account_id, queue_id, payment_method, phon
         },
         "mergeTags": {"account_id": account_id, "queue_id": queue_id, "payment_method": payment_method, "first_name": first_name}
     })
-    print("Notification SMS about queue ticket successfully sent!", flush=True)
+    return report_sent(future, "Notification SMS about queue ticket successfully sent!")
 
 def send_notification_promo_sms(account_id, promo_code, first_name, phone_number):
-    notificationapi.init('4tjgaihoti8buperss4ou9kpcp', 
-                        'g3nlqqqbj081o7aqvoln06fljcheg23rag0pe1j7s6kmggo7ffu')
     # send sms
-    notificationapi.send({
+    future = submit_sms(queue_client, {
         "notificationId": "promo",
         "templateId": "default",
         "user": {
@@ -160,15 +530,12 @@ def send_notification_promo_sms(account_id, promo_code, first_name, phone_number
         },
         "mergeTags": {"account_id": account_id, "first_name": first_name,"promo_code": promo_code}
     })
-    print("Notification SMS about promo successfully sent!", flush=True)
+    return report_sent(future, "Notification SMS about promo successfully sent!")
 
 
 def send_notification_icebreakers_sms(id,icebreaker_statement, first_name,phone_number):
-    # init
-    notificationapi.init("f130gmogsmq75oiffj86pj22o",
-                         "1m9bajhvi84ssqo49hd97srlg6huer14f2ii7mp1l986tjc74rgv")
     # send sms
-    notificationapi.send({
+    future = submit_sms(group_client, {
         "notificationId": "icebreakers",
         "templateId": "default",
         "user": {
@@ -178,14 +545,12 @@ def send_notification_icebreakers_sms(id,icebreaker_statement, first_name,phone_
         "mergeTags": {"firstName": first_name, "id": id, "statements":icebreaker_statement}
     })
 
-    print("Icebreakers Notification sent!", flush=True)
+    return report_sent(future, "Icebreakers Notification sent!")
 
 
 def send_notification_use_queue_sms(account_id, queue_id, payment_method, phone_number, first_name):
-    notificationapi.init("4tjgaihoti8buperss4ou9kpcp", 
-                        "g3nlqqqbj081o7aqvoln06fljcheg23rag0pe1j7s6kmggo7ffu")
     # send sms
-    notificationapi.send({
+    future = submit_sms(queue_client, {
         "notificationId": "use_queue",
         "templateId": "default",
         "user": {
@@ -194,7 +559,27 @@ def send_notification_use_queue_sms(account_id, queue_id, payment_method, phone_
         },
         "mergeTags": {"account_id": account_id, "queue_id": queue_id, "payment_method": payment_method, "first_name": first_name}
     })
-    print("Notification SMS about queue ticket successfully sent!", flush=True)
+    return report_sent(future, "Notification SMS about queue ticket successfully sent!")
+
+
+# message type -> sender; each returns the future of its send
+handlers = {
+    messages.Email.type: lambda message: send_notification_email(message.first_name, message.email),
+    messages.Completion.type: lambda message: send_notification_challenge_complete_sms(
+        message.mission_name, message.first_name, message.phone_number, message.award_points),
+    messages.Redeem.type: lambda message: send_notification_redemption_redeem_sms(
+        message.reward_name, message.first_name, message.phone_number, message.redemption_code),
+    messages.Inform.type: lambda message: send_notification_handleGroup_sms(
+        message.number_pax, message.first_name, message.phone_number),
+    messages.QueueTicket.type: lambda message: send_notification_queueTicket_sms(
+        message.account_id, message.queue_id, message.payment_method, message.phone_number, message.first_name),
+    messages.UseQueue.type: lambda message: send_notification_use_queue_sms(
+        message.account_id, message.queue_id, message.payment_method, message.phone_number, message.first_name),
+    messages.Promo.type: lambda message: send_notification_promo_sms(
+        message.account_id, message.promo_code, message.first_name, message.phone_number),
+    messages.Icebreakers.type: lambda message: send_notification_icebreakers_sms(
+        message.icebreaker_id, message.statements, message.first_name, message.phone_number),
+}
 
 
 if __name__ == '__main__':
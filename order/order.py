@@ -7,10 +7,9 @@ import os
 import asyncio
 
 import requests
-from invokes import invoke_http
-import pika
+from invokes import invoke_http, propagate_deadline
 import amqp_setup
-import json
+import messages
 
 from datetime import datetime
 
@@ -23,6 +22,7 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_recycle': 299}
 db = SQLAlchemy(app)
 
 CORS(app)
+propagate_deadline(app)
 
 verification_URL = environ.get(
     'verificationURL') or "http://localhost:6001/verification/"
@@ -38,15 +38,14 @@ order_URL = environ.get('orderURL') or "http://localhost:6201/order/"
 async def select_payment_method(account_id):
     payment_method1 = request.get_json()
     payment_method = payment_method1['payment_method']
-    check_qid = invoke_http(
-        queue_URL, method='GET')
-    if check_qid["code"] == 200:
-        if len(check_qid["data"]["queues"]) == 0:
-            queue_id = 1
-        else:
-            queue_id = len(check_qid["data"]["queues"]) + 1
-    else:
-        queue_id = 1
+    allocate_result = invoke_http(
+        queue_URL + "allocate", method='POST')
+    if allocate_result["code"] != 200:
+        return jsonify({
+            "code": 500,
+            "message": "Failed to allocate a queue id"
+        }), 500
+    queue_id = allocate_result["data"]["queue_id"]
 
     data = {
         "account_id": account_id,
@@ -57,7 +56,7 @@ async def select_payment_method(account_id):
     if (payment_method == "external"):
         response = invoke_http(epayment_URL + 'create_checkout_session',
                                method="POST", json={"account_id": data["account_id"]})
-        if response:
+        if response["code"] in range(200, 300):
             response["queue_id"] = data["queue_id"]
 
             ini_create_ticket = invoke_http(
@@ -76,7 +75,11 @@ async def select_payment_method(account_id):
                 }), 405
 
         else:
-            return jsonify({'status': 'error', 'message': 'Failed to create checkout session', 'data': response})
+            return jsonify({
+                "code": 502,
+                "message": "Failed to create checkout session",
+                "data": response
+            }), 502
     elif (payment_method == "promo"):
         promo_json = {
             "is_used": 1,
@@ -143,15 +146,14 @@ def ini_create_ticket(account_id):
 
     if create_ticket["code"] == 201:
         # For User Scenario 3, Update Challenge Status
-        challenge_message = {
-            "mission_id": 2,
-            "code": 201
-        }
+        challenge_message = messages.ChallengeComplete(
+            mission_id=2,
+            code=201,
+            account_ids=[create_ticket["data"]["account_id"]]
+        )
+        message, properties = messages.encode(challenge_message)
 
-        challenge_message.update(create_ticket["data"])
-        message = json.dumps(challenge_message)
-
-        amqp_setup.channel.basic_publish(exchange=amqp_setup.exchangename1, routing_key="challenge.challenge_complete", body=message, properties=pika.BasicProperties(delivery_mode=2))
+        amqp_setup.publish(amqp_setup.exchangename1, "challenge.challenge_complete", message, properties, callback=amqp_setup.log_unconfirmed)
 
 
         return jsonify({
@@ -184,20 +186,18 @@ def update_order(account_id):
     if update_account["code"] == 200:
 
         account_result = invoke_http(
-            verification_URL + "account/" + str(data["account_id"]), method='GET')
-
-        notification_message = {
-            "type": "queueticket",
-            "account_id": data["account_id"],
-            "first_name": account_result["data"]["first_name"],
-            "phone_number": account_result["data"]["phone"],
-            "payment_method": data["payment_method"],
-            "queue_id": data["queue_id"],
-            "message": "You have successfully created a queueticket."
-        }
-        message = json.dumps(notification_message)
-        amqp_setup.channel.basic_publish(exchange=amqp_setup.exchangename, routing_key="notification.sms",
-                                        body=message, properties=pika.BasicProperties(delivery_mode=2))
+            verification_URL + "account/" + str(data["account_id"]), method='GET', cache=True, coalesce=True)
+
+        notification_message = messages.QueueTicket(
+            idempotency_key="queueticket:" + str(data["queue_id"]),
+            account_id=data["account_id"],
+            first_name=account_result["data"]["first_name"],
+            phone_number=account_result["data"]["phone"],
+            payment_method=data["payment_method"],
+            queue_id=data["queue_id"]
+        )
+        message, properties = messages.encode(notification_message)
+        amqp_setup.publish(amqp_setup.exchangename, "notification.sms", message, properties, callback=amqp_setup.log_unconfirmed)
 
 
         return jsonify({
@@ -238,20 +238,18 @@ def ticket_used(queue_id):
             }), 200
         
         account_result = invoke_http(
-            verification_URL + "account/" + str(ticket_update["data"]["account_id"]), method='GET')
-
-        notification_message = {
-            "type": "use_queue",
-            "account_id": ticket_update["data"]["account_id"],
-            "first_name": account_result["data"]["first_name"],
-            "phone_number": account_result["data"]["phone"],
-            "payment_method": ticket_update["data"]["payment_method"],
-            "queue_id": ticket_update["data"]["queue_id"],
-            "message": "You have redeemed your queue ticket."
-        }
-        message = json.dumps(notification_message)
-        amqp_setup.channel.basic_publish(exchange=amqp_setup.exchangename, routing_key="notification.sms",
-                                        body=message, properties=pika.BasicProperties(delivery_mode=2))
+            verification_URL + "account/" + str(ticket_update["data"]["account_id"]), method='GET', cache=True, coalesce=True)
+
+        notification_message = messages.UseQueue(
+            idempotency_key="use_queue:" + str(ticket_update["data"]["queue_id"]),
+            account_id=ticket_update["data"]["account_id"],
+            first_name=account_result["data"]["first_name"],
+            phone_number=account_result["data"]["phone"],
+            payment_method=ticket_update["data"]["payment_method"],
+            queue_id=ticket_update["data"]["queue_id"]
+        )
+        message, properties = messages.encode(notification_message)
+        amqp_setup.publish(amqp_setup.exchangename, "notification.sms", message, properties, callback=amqp_setup.log_unconfirmed)
 
         return jsonify({
             "code": 200,
@@ -3,12 +3,13 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from os import environ
 
-from invokes import invoke_http
+from invokes import invoke_http, propagate_deadline
+from listing import paginate, handle_listing_errors
+from migrations import verify_schema, create_tables
 
-import json
 import random
-import pika
 import amqp_setup
+import messages
 
 from datetime import datetime
 
@@ -20,6 +21,8 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_recycle': 299}
 db = SQLAlchemy(app)
 
 CORS(app)
+propagate_deadline(app)
+handle_listing_errors(app)
 
 verification_URL = environ.get('verificationURL') or "http://localhost:6001/verification/"
 order_URL = environ.get('orderURL') or "http://localhost:6201/order/"
@@ -42,8 +45,13 @@ class Promo(db.Model):
         return {"account_id": self.account_id, "queue_id": self.queue_id, "promo_code": self.promo_code, "is_used": self.is_used}
 
 
+# schema changes, in order; see common/migrations.py
+MIGRATIONS = [
+    create_tables(db),
+]
+
 with app.app_context():
-  db.create_all()
+  verify_schema(db, MIGRATIONS)
   existing_promo_1 = db.session.query(Promo).filter(Promo.queue_id==1).first()
   if not existing_promo_1:
       new_promo_1 = Promo(queue_id=1, account_id=1, promo_code="123456", is_used=0)
@@ -58,14 +66,17 @@ with app.app_context():
 
 @app.get("/promo")
 def get_all():
-    promoList = Promo.query.all()
+    promoList, next_cursor = paginate(Promo.query, Promo.account_id, filters={
+        "queue_id": Promo.queue_id, "is_used": Promo.is_used
+    })
     if len(promoList):
         return jsonify(
             {
                 "code": 200,
                 "data": {
                     "promos": [promo.json() for promo in promoList]
-                }
+                },
+                "next_cursor": next_cursor
             }
         )
     return jsonify(
@@ -102,7 +113,7 @@ def create_promo():
     data = request.get_json()
     new_promo = Promo(**data)
     account_result = invoke_http(
-        verification_URL + "account/" + str(new_promo.account_id), method='GET')
+        verification_URL + "account/" + str(new_promo.account_id), method='GET', cache=True, coalesce=True)
 
     if account_result["code"] in range(500, 600):
         return jsonify(
@@ -196,19 +207,17 @@ def used_promo(account_id):
             ), 500
 
         account_result = invoke_http(
-            verification_URL + "account/" + str(updated_promo.account_id), method='GET')
-
-        notification_message = {
-            "type": "promo",
-            "account_id": updated_promo.account_id,
-            "first_name": account_result["data"]["first_name"],
-            "phone_number": account_result["data"]["phone"],
-            "promo_code": updated_promo.promo_code,
-            "message": "You have successfully redeemed a promo."
-        }
-        message = json.dumps(notification_message)
-        amqp_setup.channel.basic_publish(exchange=amqp_setup.exchangename, routing_key="notification.sms",
-                                        body=message, properties=pika.BasicProperties(delivery_mode=2))
+            verification_URL + "account/" + str(updated_promo.account_id), method='GET', cache=True, coalesce=True)
+
+        notification_message = messages.Promo(
+            idempotency_key="promo:" + str(updated_promo.account_id) + ":" + updated_promo.promo_code,
+            account_id=updated_promo.account_id,
+            first_name=account_result["data"]["first_name"],
+            phone_number=account_result["data"]["phone"],
+            promo_code=updated_promo.promo_code
+        )
+        message, properties = messages.encode(notification_message)
+        amqp_setup.publish(amqp_setup.exchangename, "notification.sms", message, properties)
 
         return jsonify(
             {
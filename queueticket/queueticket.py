@@ -4,12 +4,22 @@ from flask_cors import CORS
 import os, sys
 from os import environ
 
-from invokes import invoke_http
+from invokes import invoke_http, propagate_deadline
+from listing import paginate, stream_rows, wants_stream, handle_listing_errors
+from migrations import verify_schema, create_tables, create_index, add_column, run_sql
 import requests
 import json
 
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from sqlalchemy import func, select, update
+from sqlalchemy.exc import IntegrityError
+import atexit
+import heapq
+import signal
+import socket
+import threading
+import time
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = environ.get('dbURL')
@@ -19,10 +29,15 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_recycle': 299}
 verification_URL = environ.get('verificationURL') or "http://localhost:6001/verification/"
 order_URL = environ.get('orderURL') or "http://localhost:6201/order/"
 
+queue_id_block_size = int(environ.get("QUEUE_ID_BLOCK_SIZE", 20)) # queue ids each worker reserves from the sequence at a time
+engine_lease_seconds = int(environ.get("QUEUE_ENGINE_LEASE_SECONDS", 30)) # how long the serving process's claim on the queue engine lasts unrenewed
+
 
 db = SQLAlchemy(app)
 
 CORS(app)
+propagate_deadline(app)
+handle_listing_errors(app)
 
 class QueueTicket(db.Model):
     __tablename__ = 'queuetickets'
@@ -32,41 +47,320 @@ class QueueTicket(db.Model):
     account_id = db.Column(db.Integer, nullable = False)
     payment_method = db.Column(db.String(256), nullable=False)
     is_used = db.Column(db.Boolean, default=False, nullable=False)
+    arrival = db.Column(db.Integer, nullable=True) # place in the order tickets were created; the line follows it
 
 
-    def __init__(self, queue_id, is_priority, account_id, payment_method, is_used):
+    def __init__(self, queue_id, is_priority, account_id, payment_method, is_used, arrival=None):
         self.queue_id = queue_id
         self.is_priority = is_priority
         self.account_id = account_id
         self.payment_method = payment_method
         self.is_used = is_used
+        self.arrival = arrival
 
     def json(self):
         return {"queue_id": self.queue_id, "is_priority": self.is_priority, "account_id":self.account_id, "payment_method": self.payment_method, "is_used": self.is_used}
 
+class QueueSequence(db.Model):
+    __tablename__ = 'queue_sequences'
+
+    name = db.Column(db.String(64), primary_key=True)
+    next_id = db.Column(db.Integer, nullable=False)
+
+    def __init__(self, name, next_id):
+        self.name = name
+        self.next_id = next_id
+
+
+class QueueIdAllocator:
+    """Hands out queue ids from blocks reserved in the queue_sequences row, so ids never collide
+       between workers and only one in block_size allocations touches the database.
+    """
+    sequence_name = "queuetickets"
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.next_id = 0
+        self.end_id = 0 # first id past the reserved block
+        self.lock = threading.Lock()
+
+    def allocate(self):
+        with self.lock:
+            if self.next_id >= self.end_id:
+                self.next_id = self.reserve_block()
+                self.end_id = self.next_id + self.block_size
+            queue_id = self.next_id
+            self.next_id += 1
+            return queue_id
+
+    def reserve_block(self):
+        # its own short transaction, so the row lock is held only for the bump
+        with db.engine.begin() as connection:
+            start = connection.execute(select(QueueSequence.next_id).where(
+                QueueSequence.name == self.sequence_name).with_for_update()).scalar_one()
+            connection.execute(update(QueueSequence).where(QueueSequence.name == self.sequence_name).values(
+                next_id=QueueSequence.next_id + self.block_size))
+        return start
+
+    def start_sequence(self):
+        # the sequence starts (or continues) past every queue id already in use
+        first_free = (db.session.query(func.max(QueueTicket.queue_id)).scalar() or 0) + 1
+        sequence = db.session.get(QueueSequence, self.sequence_name)
+        try:
+            if sequence is None:
+                db.session.add(QueueSequence(self.sequence_name, first_free))
+            elif sequence.next_id < first_free:
+                sequence.next_id = first_free
+            db.session.commit()
+        except IntegrityError:
+            # another worker created it first
+            db.session.rollback()
+
+
+queue_id_allocator = QueueIdAllocator(queue_id_block_size)
+
+
+class QueueEngineLease(db.Model):
+    __tablename__ = 'queue_engine_leases'
+
+    name = db.Column(db.String(64), primary_key=True)
+    owner = db.Column(db.String(128), nullable=False)
+    expires = db.Column(db.DateTime, nullable=False)
+
+    def __init__(self, name, owner, expires):
+        self.name = name
+        self.owner = owner
+        self.expires = expires
+
+
+class EngineLease:
+    """The queue engine lives in the memory of one process, so exactly one queueticket process may serve:
+       a second one would keep its own line, and /position and /next would disagree between them.
+       The serving process holds this lease in the database and renews it; another process refuses to
+       start while it is held. The owner is the host name, so a restarted container (or a debug reloader
+       restart) takes its own lease back at once, and the lease is released on a clean exit.
+    """
+    name = "queue_engine"
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.owner = socket.gethostname()
+
+    def acquire(self):
+        # True when this process holds the lease (again) until now + seconds
+        now = datetime.now()
+        with db.engine.begin() as connection:
+            lease = connection.execute(select(QueueEngineLease.owner, QueueEngineLease.expires).where(
+                QueueEngineLease.name == self.name).with_for_update()).first()
+            if lease is None:
+                connection.execute(QueueEngineLease.__table__.insert().values(
+                    name=self.name, owner=self.owner, expires=now + timedelta(seconds=self.seconds)))
+                return True
+            if lease.owner != self.owner and lease.expires > now:
+                return False
+            connection.execute(update(QueueEngineLease).where(QueueEngineLease.name == self.name).values(
+                owner=self.owner, expires=now + timedelta(seconds=self.seconds)))
+            return True
+
+    def start(self):
+        try:
+            acquired = self.acquire()
+        except IntegrityError:
+            # another process inserted the lease first
+            acquired = False
+        if not acquired:
+            raise SystemExit("Another queueticket process holds the queue engine lease; "
+                             "the queue engine is in-memory, so only one queueticket process may run.")
+        atexit.register(self.release)
+        # docker stop sends SIGTERM, which would otherwise end the process without running atexit
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        threading.Thread(target=self.renew_forever, daemon=True).start()
+
+    def release(self):
+        try:
+            with app.app_context(), db.engine.begin() as connection:
+                connection.execute(QueueEngineLease.__table__.delete().where(
+                    QueueEngineLease.name == self.name, QueueEngineLease.owner == self.owner))
+        except Exception as e:
+            print("Failed to release the queue engine lease:", e, flush=True)
+
+    def renew_forever(self):
+        while True:
+            time.sleep(self.seconds / 3)
+            try:
+                with app.app_context():
+                    renewed = self.acquire()
+            except Exception as e:
+                print("Failed to renew the queue engine lease:", e, flush=True)
+                continue
+            if not renewed:
+                # another process took over while this one stalled: its line is the one that counts now
+                print("Lost the queue engine lease; stopping.", flush=True)
+                os._exit(1)
+
+
+engine_lease = EngineLease(engine_lease_seconds)
+
+
+class Fenwick:
+    """Counts of pending queue ids, answering "how many ids <= queue_id" in O(log n).
+       Grows (and is rebuilt) when an id past its size is added.
+    """
+    def __init__(self, size=1024):
+        self.size = size
+        self.tree = [0] * (size + 1)
+        self.members = set()
+
+    def add(self, queue_id):
+        if queue_id > self.size:
+            self.grow(queue_id)
+        self.members.add(queue_id)
+        self.update(queue_id, 1)
+
+    def remove(self, queue_id):
+        self.members.discard(queue_id)
+        self.update(queue_id, -1)
+
+    def update(self, queue_id, delta):
+        while queue_id <= self.size:
+            self.tree[queue_id] += delta
+            queue_id += queue_id & -queue_id
+
+    def count_upto(self, queue_id):
+        queue_id = min(queue_id, self.size)
+        count = 0
+        while queue_id > 0:
+            count += self.tree[queue_id]
+            queue_id -= queue_id & -queue_id
+        return count
+
+    def grow(self, queue_id):
+        self.size = max(self.size * 2, queue_id)
+        self.tree = [0] * (self.size + 1)
+        for member in self.members:
+            self.update(member, 1)
+
+
+class QueueEngine:
+    """The line of pending (unused) tickets: priority tickets first, each group in arrival order.
+       Queue ids come from per-worker blocks and are handed out before checkout, so they say nothing
+       about arrival; the line follows the arrival number given to a ticket when it is created.
+       A heap gives the next ticket and one Fenwick tree per group, indexed by arrival, gives a ticket's
+       position, both in O(log n). Rebuilt from the database when the service starts.
+    """
+    def __init__(self):
+        self.pending = {} # queue_id -> (is_priority, arrival)
+        self.heap = [] # (0 for priority / 1 otherwise, arrival, queue_id); removed tickets are skipped lazily
+        self.priority = Fenwick()
+        self.regular = Fenwick()
+        self.last_arrival = 0
+        self.lock = threading.Lock()
+
+    def next_arrival(self):
+        with self.lock:
+            self.last_arrival += 1
+            return self.last_arrival
+
+    def add(self, queue_id, is_priority, arrival):
+        with self.lock:
+            if queue_id in self.pending:
+                return
+            self.pending[queue_id] = (bool(is_priority), arrival)
+            self.last_arrival = max(self.last_arrival, arrival)
+            heapq.heappush(self.heap, (0 if is_priority else 1, arrival, queue_id))
+            (self.priority if is_priority else self.regular).add(arrival)
+
+    def remove(self, queue_id):
+        with self.lock:
+            if queue_id not in self.pending:
+                return
+            is_priority, arrival = self.pending.pop(queue_id)
+            (self.priority if is_priority else self.regular).remove(arrival)
+
+    def position(self, queue_id):
+        # 1-based place in line, or None when the ticket is not waiting
+        with self.lock:
+            if queue_id not in self.pending:
+                return None
+            is_priority, arrival = self.pending[queue_id]
+            if is_priority:
+                return self.priority.count_upto(arrival)
+            return len(self.priority.members) + self.regular.count_upto(arrival)
+
+    def next(self):
+        # (queue_id, is_priority) of the ticket at the front of the line, or None
+        with self.lock:
+            while self.heap and self.pending.get(self.heap[0][2]) != (self.heap[0][0] == 0, self.heap[0][1]):
+                heapq.heappop(self.heap)
+            if not self.heap:
+                return None
+            queue_id = self.heap[0][2]
+            return queue_id, self.pending[queue_id][0]
+
+    def waiting(self):
+        with self.lock:
+            return len(self.pending)
+
+    def load(self, queuetickets, last_arrival):
+        with self.lock:
+            self.last_arrival = max(self.last_arrival, last_arrival or 0)
+        for queueticket in queuetickets:
+            if not queueticket.is_used:
+                self.add(queueticket.queue_id, queueticket.is_priority, queueticket.arrival)
+
+    def update(self, queueticket):
+        if queueticket.is_used:
+            self.remove(queueticket.queue_id)
+        else:
+            self.add(queueticket.queue_id, queueticket.is_priority, queueticket.arrival)
+
+
+queue_engine = QueueEngine()
+
+
+# schema changes, in order; see common/migrations.py
+MIGRATIONS = [
+    create_tables(db),
+    create_index("queuetickets", "queuetickets_account", ["account_id"]),
+    create_tables(db), # queue_engine_leases
+    add_column("queuetickets", "arrival", "INTEGER NULL"),
+    # tickets created before arrivals were recorded keep their old place in line
+    run_sql("UPDATE queuetickets SET arrival = queue_id WHERE arrival IS NULL"),
+]
+
 with app.app_context():
-  db.create_all()
+  verify_schema(db, MIGRATIONS)
   existing_queue_ticket_1 = db.session.query(QueueTicket).filter(QueueTicket.queue_id==1).first()
   if not existing_queue_ticket_1:
-      new_queue_ticket_1 = QueueTicket(queue_id=1, is_priority=1, account_id=1, payment_method="promo", is_used=0)
-      new_queue_ticket_2 = QueueTicket(queue_id=2, is_priority=1, account_id=2, payment_method="external", is_used=0)
-      new_queue_ticket_3 = QueueTicket(queue_id=3, is_priority=1, account_id=3, payment_method="loyalty", is_used=0)
+      new_queue_ticket_1 = QueueTicket(queue_id=1, is_priority=1, account_id=1, payment_method="promo", is_used=0, arrival=1)
+      new_queue_ticket_2 = QueueTicket(queue_id=2, is_priority=1, account_id=2, payment_method="external", is_used=0, arrival=2)
+      new_queue_ticket_3 = QueueTicket(queue_id=3, is_priority=1, account_id=3, payment_method="loyalty", is_used=0, arrival=3)
       db.session.add(new_queue_ticket_1)
       db.session.add(new_queue_ticket_2)
       db.session.add(new_queue_ticket_3)
       db.session.commit()
+  queue_id_allocator.start_sequence()
+  queue_engine.load(QueueTicket.query.filter_by(is_used=False).all(),
+                    db.session.query(func.max(QueueTicket.arrival)).scalar())
 
 
 @app.get("/queueticket/")
 def get_all():
-    queueList = QueueTicket.query.all()
+    filters = {
+        "account_id": QueueTicket.account_id, "is_priority": QueueTicket.is_priority, "is_used": QueueTicket.is_used, "payment_method": QueueTicket.payment_method
+    }
+    if wants_stream():
+        return stream_rows(QueueTicket.query, QueueTicket.queue_id, filters=filters)
+
+    queueList, next_cursor = paginate(QueueTicket.query, QueueTicket.queue_id, filters=filters)
     if len(queueList):
         return jsonify(
             {
                 "code": 200,
                 "data": {
                     "queues": [queue.json() for queue in queueList]
-                }
+                },
+                "next_cursor": next_cursor
             }
         )
     return jsonify(
@@ -93,6 +387,72 @@ def get_by_id(queue_id):
         }
     ), 404
 
+@app.get("/queueticket/<int:queue_id>/position")
+def get_position(queue_id):
+    position = queue_engine.position(queue_id)
+    if position is None:
+        return jsonify(
+            {
+                "code": 404,
+                "data": {
+                    "queue_id": queue_id
+                },
+                "message": "queueticket is not waiting in the queue."
+            }
+        ), 404
+    return jsonify(
+        {
+            "code": 200,
+            "data": {
+                "queue_id": queue_id,
+                "position": position,
+                "waiting": queue_engine.waiting()
+            }
+        }
+    ), 200
+
+@app.get("/queueticket/next")
+def get_next():
+    next_ticket = queue_engine.next()
+    if next_ticket is None:
+        return jsonify(
+            {
+                "code": 404,
+                "message": "There are no queues."
+            }
+        ), 404
+    return jsonify(
+        {
+            "code": 200,
+            "data": {
+                "queue_id": next_ticket[0],
+                "is_priority": next_ticket[1],
+                "waiting": queue_engine.waiting()
+            }
+        }
+    ), 200
+
+@app.route("/queueticket/allocate", methods=['POST'])
+def allocate_queue_id():
+    try:
+        queue_id = queue_id_allocator.allocate()
+    except:
+        return jsonify(
+            {
+                "code": 500,
+                "message": "An error occurred allocating a queue id."
+            }
+        ), 500
+
+    return jsonify(
+        {
+            "code": 200,
+            "data": {
+                "queue_id": queue_id
+            }
+        }
+    ), 200
+
 @app.route("/queueticket/", methods=['POST'])
 def create_queueticket():
     if request.json is None:
@@ -100,29 +460,17 @@ def create_queueticket():
     
     data = request.get_json()
 
-    verify_queue = invoke_http(
-        verification_URL + "queueticket/" + str(data["queue_id"]), method='GET')
-
-    if verify_queue["code"] != 200:
-        new_queue = {
-            "queue_id": data["queue_id"],
-            "is_priority": 1,
-            "account_id": data["account_id"],
-            "payment_method": data["payment_method"],
-            "is_used": 0
-        }
-    else:
-        data["queue_id"] += 1
-        new_queue = {
-            "queue_id": data["queue_id"],
-            "is_priority": 1,
-            "account_id": data["account_id"],
-            "payment_method": data["payment_method"],
-            "is_used": 0
-        }
+    # ids come from the allocator, so they are unique without probing for the next free one
+    new_queue = {
+        "queue_id": data.get("queue_id") or queue_id_allocator.allocate(),
+        "is_priority": 1,
+        "account_id": data["account_id"],
+        "payment_method": data["payment_method"],
+        "is_used": 0
+    }
 
     account_result = invoke_http(
-        verification_URL + "account/" + str(new_queue["account_id"]), method='GET')
+        verification_URL + "account/" + str(new_queue["account_id"]), method='GET', coalesce=True)
 
     if account_result["code"] in range(500, 600):
         return jsonify(
@@ -152,15 +500,17 @@ def create_queueticket():
             ), 502
 
     try:
-        
+        arrival = queue_engine.next_arrival()
         db.session.add(QueueTicket(
             queue_id=new_queue["queue_id"],
             is_priority=new_queue["is_priority"],
             account_id=new_queue["account_id"],
             payment_method=new_queue["payment_method"],
-            is_used=new_queue["is_used"]
+            is_used=new_queue["is_used"],
+            arrival=arrival
         ))
         db.session.commit()
+        queue_engine.add(new_queue["queue_id"], new_queue["is_priority"], arrival)
 
     except:
         return jsonify(
@@ -185,6 +535,7 @@ def delete_order(queue_id):
     if queueticket:
         db.session.delete(queueticket)
         db.session.commit()
+        queue_engine.remove(queueticket.queue_id)
         return jsonify(
             {
                 "code": 200,
@@ -211,6 +562,7 @@ def queue_used(queue_id):
         updated_queue.is_used = data["is_used"]
 
         db.session.commit()
+        queue_engine.update(updated_queue)
 
         return jsonify(
             {
@@ -232,4 +584,9 @@ def queue_used(queue_id):
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=6202, debug=True)
\ No newline at end of file
+    debug = True
+    # the debug reloader runs this module in a watcher process as well; only the serving process takes the lease
+    if not debug or environ.get("WERKZEUG_RUN_MAIN") == "true":
+        with app.app_context():
+            engine_lease.start()
+    app.run(host='0.0.0.0', port=6202, debug=debug)
\ No newline at end of file
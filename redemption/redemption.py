@@ -5,12 +5,16 @@ from os import environ
 
 from datetime import datetime, timedelta
 
-from invokes import invoke_http
-
-import random
+from invokes import invoke_http, propagate_deadline
+from listing import paginate, stream_rows, wants_stream, handle_listing_errors
+from migrations import verify_schema, create_tables, create_index
+
+import secrets
+import threading
+from collections import deque
+from sqlalchemy.exc import IntegrityError
 import amqp_setup
-import pika
-import json
+import messages
 
 app = Flask(__name__)
 app.config['JSON_SORT_KEYS'] = False
@@ -21,11 +25,16 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_recycle': 299}
 db = SQLAlchemy(app)
 
 CORS(app)
+propagate_deadline(app)
+handle_listing_errors(app)
 
 verification_URL = environ.get(
     'verificationURL') or "http://localhost:6001/verification/"
 loyalty_URL = environ.get('loyaltyURL') or "http://localhost:6301/loyalty/"
 
+code_pool_size = int(environ.get("REDEMPTION_CODE_POOL_SIZE", 200)) # unused codes kept ready; refilled when half are gone
+code_insert_attempts = 5 # a code taken by another worker between refill and insert is replaced and retried
+
 
 class Redemption(db.Model):
     __tablename__ = 'redemptions'
@@ -48,28 +57,100 @@ class Redemption(db.Model):
         return {"redemption_id": self.redemption_id, "account_id": self.account_id, "reward_id": self.reward_id, "redemption_code": self.redemption_code, "status": self.status, "redemption_date": self.redemption_date, "created": self.created, "modified": self.modified}
 
 
+# schema changes, in order; see common/migrations.py
+MIGRATIONS = [
+    create_tables(db),
+    create_index("redemptions", "redemptions_account", ["account_id"]),
+    create_index("redemptions", "redemptions_code", ["redemption_code"], unique=True),
+]
+
 with app.app_context():
-    db.create_all()
+    verify_schema(db, MIGRATIONS)
 
 
 def generate_redemption_code():
     code = ''
     for i in range(4):
-        code += ''.join(random.sample('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789', 4)) + '-'
-    code += ''.join(random.sample('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789', 2))
+        code += ''.join(secrets.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789') for j in range(4)) + '-'
+    code += ''.join(secrets.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789') for j in range(2))
     return code
 
 
+class CodePool:
+    """Redemption codes generated ahead of time and checked against the table in bulk, so issuing one
+       is a pop. The unique index on redemption_code is what guarantees uniqueness; the pool only makes
+       a collision at insert time rare.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.codes = deque()
+        self.refill_needed = threading.Event()
+
+    def start(self):
+        self.refill_needed.set()
+        threading.Thread(target=self.refill_forever, daemon=True).start()
+
+    def take(self):
+        if len(self.codes) <= self.size // 2:
+            self.refill_needed.set()
+        try:
+            return self.codes.popleft()
+        except IndexError:
+            # the refill is behind: a fresh code is still almost certainly free
+            return generate_redemption_code()
+
+    def refill_forever(self):
+        while True:
+            self.refill_needed.wait()
+            self.refill_needed.clear()
+            try:
+                with app.app_context():
+                    self.refill()
+            except Exception as e:
+                print("Failed to refill the redemption code pool:", e, flush=True)
+
+    def refill(self):
+        candidates = set(generate_redemption_code() for i in range(self.size - len(self.codes)))
+        if not candidates:
+            return
+        taken = set(code for code, in db.session.query(Redemption.redemption_code).filter(
+            Redemption.redemption_code.in_(candidates)))
+        db.session.rollback()
+        self.codes.extend(candidates - taken)
+
+
+code_pool = CodePool(code_pool_size)
+code_pool.start()
+
+
+def claim_redemption(criterion):
+    # "Not Claimed" -> "Claimed" in one conditional UPDATE, so two counters can never both claim it
+    now = datetime.now()
+    claimed = Redemption.query.filter(criterion, Redemption.status != "Claimed").update(
+        {Redemption.status: "Claimed", Redemption.redemption_date: now, Redemption.modified: now},
+        synchronize_session=False)
+    redemption = Redemption.query.filter(criterion).first()
+    db.session.commit()
+    return claimed, redemption
+
+
 @app.route("/redemption")
 def get_all():
-    redemptionlist = Redemption.query.all()
+    filters = {
+        "account_id": Redemption.account_id, "reward_id": Redemption.reward_id, "status": Redemption.status
+    }
+    if wants_stream():
+        return stream_rows(Redemption.query, Redemption.redemption_id, filters=filters)
+
+    redemptionlist, next_cursor = paginate(Redemption.query, Redemption.redemption_id, filters=filters)
     if len(redemptionlist):
         return jsonify(
             {
                 "code": 200,
                 "data": {
                     "redemptions": [redemption.json() for redemption in redemptionlist]
-                }
+                },
+                "next_cursor": next_cursor
             }
         ), 200
     return jsonify(
@@ -125,7 +206,7 @@ def create_redemption():
     redemption = Redemption(**data)
 
     account_result = invoke_http(
-        verification_URL + "account/" + str(redemption.account_id), method='GET')
+        verification_URL + "account/" + str(redemption.account_id), method='GET', cache=True, coalesce=True)
 
     if account_result["code"] in range(500, 600):
         return jsonify(
@@ -147,7 +228,7 @@ def create_redemption():
         ), 400
 
     reward_result = invoke_http(
-        verification_URL + "reward/" + str(redemption.reward_id), method='GET')
+        verification_URL + "reward/" + str(redemption.reward_id), method='GET', cache=True, coalesce=True)
 
     if reward_result["code"] in range(500, 600):
         return jsonify(
@@ -197,12 +278,24 @@ def create_redemption():
     if redeem_result["code"] in range(300, 500):
         return jsonify(redeem_result), 400
 
-    redemption.redemption_code = generate_redemption_code()
-
-    try:
-        db.session.add(redemption)
-        db.session.commit()
-    except:
+    for attempt in range(code_insert_attempts):
+        redemption.redemption_code = code_pool.take()
+        try:
+            db.session.add(redemption)
+            db.session.commit()
+            break
+        except IntegrityError:
+            # the code was issued elsewhere in the meantime: take the next one
+            db.session.rollback()
+        except:
+            db.session.rollback()
+            return jsonify(
+                {
+                    "code": 500,
+                    "message": "An error occurred creating the redemption.",
+                }
+            ), 500
+    else:
         return jsonify(
             {
                 "code": 500,
@@ -210,13 +303,12 @@ def create_redemption():
             }
         ), 500
 
-    notification_message = {"type": "redeem", "reward_name": reward_result["data"]["name"], "first_name": account_result["data"]
-                            ["first_name"], "phone_number": account_result["data"]["phone"], "redemption_code": redemption.redemption_code}
+    notification_message = messages.Redeem(idempotency_key="redeem:" + str(redemption.redemption_id), reward_name=reward_result["data"]["name"], first_name=account_result["data"]
+                            ["first_name"], phone_number=account_result["data"]["phone"], redemption_code=redemption.redemption_code)
 
-    message = json.dumps(notification_message)
+    message, properties = messages.encode(notification_message)
 
-    amqp_setup.channel.basic_publish(exchange=amqp_setup.exchangename, routing_key="notification.sms",
-                                     body=message, properties=pika.BasicProperties(delivery_mode=2))
+    amqp_setup.publish(amqp_setup.exchangename, "notification.sms", message, properties)
 
     return jsonify(
         {
@@ -228,47 +320,47 @@ def create_redemption():
 
 @app.route("/redemption/<redemption_id>/claimed", methods=['PATCH'])
 def update_redemption_claimed(redemption_id):
-    if (not Redemption.query.filter_by(redemption_id=redemption_id).first()):
+    return claimed_response(Redemption.redemption_id == redemption_id, {"redemption_id": redemption_id})
+
+
+@app.route("/redemption/code/<redemption_code>/claimed", methods=['PATCH'])
+def update_redemption_claimed_by_code(redemption_code):
+    # counters scan or type the code the guest was sent; it is looked up through its unique index
+    return claimed_response(Redemption.redemption_code == redemption_code, {"redemption_code": redemption_code})
+
+
+def claimed_response(criterion, ident):
+    try:
+        claimed, redemption = claim_redemption(criterion)
+
+    except:
+        db.session.rollback()
+        return jsonify(
+            {
+                "code": 500,
+                "data": ident,
+                "message": "An error occurred updating the redemption."
+            }
+        ), 500
+
+    if not redemption:
         return jsonify(
             {
                 "code": 404,
-                "data": {
-                    "redemption_id": redemption_id
-                },
+                "data": ident,
                 "message": "Redemption not found."
             }
         ), 404
 
-    redemption = Redemption.query.filter_by(
-        redemption_id=redemption_id).first()
-
-    if redemption.status == "Claimed":
+    if not claimed:
         return jsonify(
             {
                 "code": 400,
-                "data": {
-                    "redemption_id": redemption_id
-                },
+                "data": ident,
                 "message": "Redemption has already been claimed."
             }
         ), 400
 
-    try:
-        redemption.status = "Claimed"
-        redemption.redemption_date = datetime.now()
-        db.session.commit()
-
-    except:
-        return jsonify(
-            {
-                "code": 500,
-                "data": {
-                    "redemption": redemption
-                },
-                "message": "An error occurred updating the redemption."
-            }
-        ), 500
-
     return jsonify(
         {
             "code": 200,
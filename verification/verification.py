@@ -3,18 +3,19 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from os import environ
 
-from invokes import invoke_http
+from invokes import invoke_http, invoke_many, propagate_deadline, cacheable
 
-import json
+import asyncio
 import threading
-import pika
 import amqp_setup
+import messages
 
 
 app = Flask(__name__)
 app.config['JSON_SORT_KEYS'] = False
 
 CORS(app)
+propagate_deadline(app)
 
 account_URL = environ.get('accountURL') or "http://localhost:6000/account/"
 mission_URL = environ.get('missionURL') or "http://localhost:6300/mission/"
@@ -27,6 +28,23 @@ icebreakers_url = environ.get(
 challenge_url = environ.get(
     'challengeURL') or "http://localhost:6302/challenge/"
 
+# Seconds that slowly changing lookups may be served from cache, here and by the callers of verification.
+account_cache_ttl = int(environ.get('accountCacheTTL') or 30)
+mission_cache_ttl = int(environ.get('missionCacheTTL') or 300)
+reward_cache_ttl = int(environ.get('rewardCacheTTL') or 300)
+
+# Account ids sent per /account/batch call; at most the account service's accountMaxBatchIds.
+account_batch_size = int(environ.get('accountBatchSize') or 500)
+
+# Lookup kinds served by /verification/batch: the service url and the cache ttl (None = not cached).
+batch_lookups = {
+    "account": (account_URL, account_cache_ttl),
+    "mission": (mission_URL, mission_cache_ttl),
+    "reward": (reward_URL, reward_cache_ttl),
+    "grouping": (grouping_URL, None),
+    "queueticket": (queue_URL, None)
+}
+
 
 monitorBindingKey = '#'
 
@@ -52,74 +70,133 @@ def start_consuming():
 # required signature for the callback; no return
 def challenge_callback(channel, method, properties, body):
     print("This is verification.py...", flush=True)
-    print("Received message:", json.loads(body), flush=True)
-
-    data = json.loads(body)
-
-    if data["code"] not in range(200, 300):
-        return
-
-    if data["mission_id"] == 1:
-        for account_id in data["group_obj"]["list_account"]:
-            challenge_result = invoke_http(challenge_url + "account/" + str(
-                account_id) + "/mission/" + str(data["mission_id"]), method='GET')
-
-            if challenge_result["code"] not in range(200, 300):
-                return
-
-            if challenge_result["data"]["status"] == "Completed":
-                return
-
-            update_challenge_result = invoke_http(
-                challenge_url + str(challenge_result["data"]["challenge_id"]) + "/complete", method='PATCH')
-
-            print(update_challenge_result)
-
-        return
 
-    challenge_result = invoke_http(challenge_url + "account/" + str(
-        data["account_id"]) + "/mission/" + str(data["mission_id"]), method='GET')
+    message = messages.decode(body, properties, default_type=messages.ChallengeComplete.type)
+    print("Received message:", message, flush=True)
 
-    if challenge_result["code"] not in range(200, 300):
+    if message.code not in range(200, 300):
         return
 
-    if challenge_result["data"]["status"] == "Completed":
+    if not message.account_ids:
         return
 
+    # one call completes the challenge of every account; ones already completed are skipped there
+    complete_json = [{"account_id": account_id, "mission_id": message.mission_id} for account_id in message.account_ids]
     update_challenge_result = invoke_http(
-        challenge_url + str(challenge_result["data"]["challenge_id"]) + "/complete", method='PATCH')
+        challenge_url + "complete/bulk", method='POST', json=complete_json)
 
     print(update_challenge_result)
 
 
 @app.route("/verification/account/<account_id>")
+@cacheable(account_cache_ttl)
 def verify_account(account_id):
     return invoke_http(
-        account_URL + str(account_id), method='GET')
+        account_URL + str(account_id), method='GET', cache=account_cache_ttl, coalesce=True)
 
 
 @app.route("/verification/grouping/<grouping_id>")
 def verify_grouping(grouping_id):
     return invoke_http(
-        grouping_URL + str(grouping_id),  method='GET')
+        grouping_URL + str(grouping_id),  method='GET', coalesce=True)
 
 
 @app.route("/verification/mission/<mission_id>")
+@cacheable(mission_cache_ttl)
 def verify_mission(mission_id):
     return invoke_http(
-        mission_URL + str(mission_id), method='GET')
+        mission_URL + str(mission_id), method='GET', cache=mission_cache_ttl, coalesce=True)
 
 
 @app.route("/verification/reward/<reward_id>")
+@cacheable(reward_cache_ttl)
 def verify_reward(reward_id):
     return invoke_http(
-        reward_URL + str(reward_id), method='GET')
+        reward_URL + str(reward_id), method='GET', cache=reward_cache_ttl, coalesce=True)
 
 
 @app.route("/verification/queueticket/<queue_id>")
 def verify_queue(queue_id):
     return invoke_http(
-        queue_URL + str(queue_id), method='GET')
+        queue_URL + str(queue_id), method='GET', coalesce=True)
+
+
+@app.route("/verification/batch", methods=['POST'])
+def verify_batch():
+    # Resolve many {kind, id} lookups in one call: duplicates are dropped and the rest are fetched in parallel.
+    if not request.is_json:
+        return jsonify({
+            "code": 400,
+            "message": "Invalid JSON input: " + str(request.get_data())
+        }), 400
+
+    data = request.get_json()
+    lookups = data.get("lookups") if isinstance(data, dict) else data
+    # optional projection of the account lookups, e.g. {"fields": {"account": ["first_name", "phone"]}}
+    fields = data.get("fields", {}) if isinstance(data, dict) else {}
+    account_fields = fields.get("account") if isinstance(fields, dict) else None
+
+    if not isinstance(lookups, list) or not all(isinstance(lookup, dict) for lookup in lookups):
+        return jsonify({
+            "code": 400,
+            "message": "Expected a list of {kind, id} lookups, or an object with one under \"lookups\"."
+        }), 400
+    if not isinstance(fields, dict) or not (account_fields is None or isinstance(account_fields, list)):
+        return jsonify({
+            "code": 400,
+            "message": "fields must map a lookup kind to a list of field names."
+        }), 400
+
+    unique_lookups = {}
+    invalid_lookups = {} # (kind, id) -> result of the lookups answered 400 without a call
+    for lookup in lookups:
+        kind, lookup_id = lookup.get("kind"), lookup.get("id")
+        if kind not in batch_lookups:
+            return jsonify({
+                "code": 400,
+                "data": {"lookup": lookup},
+                "message": "Unknown lookup kind. Expected one of: " + ", ".join(batch_lookups) + "."
+            }), 400
+        if isinstance(lookup_id, bool) or not isinstance(lookup_id, (int, str)) or not str(lookup_id).isdigit():
+            invalid_lookups[(kind, str(lookup_id if lookup_id is not None else ""))] = {
+                "code": 400, "message": "Lookup id must be a whole number."}
+            continue
+        # ids are keyed the way the services key them, so "007" and 7 are one lookup
+        unique_lookups[(kind, str(int(lookup_id)))] = True
+
+    # accounts are resolved by one query per account_batch_size ids, every other lookup by its own call
+    account_ids = [lookup_id for kind, lookup_id in unique_lookups if kind == "account"]
+    account_chunks = [account_ids[start:start + account_batch_size] for start in range(0, len(account_ids), account_batch_size)]
+    other_lookups = [(kind, lookup_id) for kind, lookup_id in unique_lookups if kind != "account"]
+
+    calls = []
+    for kind, lookup_id in other_lookups:
+        url, ttl = batch_lookups[kind]
+        calls.append({"url": url + lookup_id, "method": 'GET', "cache": ttl, "coalesce": True})
+    for chunk in account_chunks:
+        calls.append({"url": account_URL + "batch", "method": 'POST', "json": {"ids": chunk, "fields": account_fields}})
+    results = asyncio.run(invoke_many(calls))
+
+    batch_result = {kind: {} for kind, _ in list(unique_lookups) + list(invalid_lookups)}
+    for (kind, lookup_id), result in zip(other_lookups, results):
+        batch_result[kind][lookup_id] = result
+
+    for chunk, accounts_result in zip(account_chunks, results[len(other_lookups):]):
+        for account_id in chunk:
+            if accounts_result["code"] not in range(200, 300):
+                batch_result["account"][account_id] = accounts_result
+            elif account_id in accounts_result["data"]["accounts"]:
+                batch_result["account"][account_id] = {"code": 200, "data": accounts_result["data"]["accounts"][account_id]}
+            else:
+                batch_result["account"][account_id] = {"code": 404, "message": "Account not found."}
+
+    for (kind, lookup_id), result in invalid_lookups.items():
+        batch_result[kind][lookup_id] = result
+
+    return jsonify({
+        "code": 200,
+        "data": batch_result
+    }), 200
 
 
 @app.route("/verification/icebreakers")